@@ -0,0 +1,50 @@
+##
+##
+
+import os
+import sys
+import argparse
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+
+from benchmark import codec, messenger, outputs
+from benchmark.harness import measure, report, save, load
+
+SUITES = {
+    "codec": codec,
+    "messenger": messenger,
+    "outputs": outputs,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmark")
+    parser.add_argument('-s', '--suite', action='append', choices=list(SUITES), help="Suite to run (default all)")
+    parser.add_argument('-k', '--match', action='store', help="Only run cases whose name contains this string")
+    parser.add_argument('-t', '--time', action='store', type=float, help="Target seconds per timed run", default=0.2)
+    parser.add_argument('-r', '--repeat', action='store', type=int, help="Timed runs per case", default=5)
+    parser.add_argument('--save', action='store', help="Write results to a baseline file")
+    parser.add_argument('--compare', action='store', help="Compare results with a baseline file")
+    parser.add_argument('--threshold', action='store', type=float, help="Slowdown reported as a regression", default=0.1)
+    parser.add_argument('--fail', action='store_true', help="Exit non-zero when a regression is found")
+    options = parser.parse_args()
+
+    baseline = load(options.compare) if options.compare else None
+    results = []
+    for name in options.suite if options.suite else SUITES:
+        for case in SUITES[name].cases():
+            if options.match and options.match not in case.name:
+                continue
+            results.append(measure(case, options.time, options.repeat))
+
+    regressions = report(results, baseline, options.threshold)
+    if options.save:
+        save(options.save, results)
+    if regressions and options.fail:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
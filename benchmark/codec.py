@@ -0,0 +1,119 @@
+##
+##
+
+import sys
+import struct
+from io import BytesIO
+from typing import List
+from pythonblip.varint import encode_uvarint, decode_uvarint, encode_many, decode_many
+from pythonblip.properties import PropertyCodec, _encode_items
+from .harness import Case
+from .payloads import REV_PROPERTIES
+
+HEADERS = [(1, 0x00), (127, 0x08), (4821, 0x41), (1048576, 0x61)]
+
+
+## The codec this package replaced (struct-packed input, one BytesIO read per byte), kept as the "before" reference
+def legacy_put_uvarint(x: bytes):
+    _output = bytearray()
+    uvarint_ux = int.from_bytes(x, sys.byteorder)
+    i = 0
+    while uvarint_ux >= 0x80:
+        b = uvarint_ux & 0xff
+        b = b | 0x80
+        _output.append(b)
+        uvarint_ux >>= 7
+        i += 1
+    f = uvarint_ux & 0xff
+    _output.append(f)
+    return _output, i + 1
+
+
+def legacy_read_uvarint(r: BytesIO):
+    x = 0
+    s = 0
+    for n in range(10):
+        b = int.from_bytes(r.read(1), sys.byteorder)
+        if b < 0x80:
+            x = x | b << s
+            return x, n + 1
+        x = x | (b & 0x7f) << s
+        s += 7
+    return 0, 0
+
+
+def cases() -> List[Case]:
+    frames = []
+    for number, flags in HEADERS:
+        frame = bytearray()
+        encode_uvarint(number, frame)
+        encode_uvarint(flags, frame)
+        frames.append(memoryview(bytes(frame)))
+
+    def varint_encode():
+        for number, flags in HEADERS:
+            header = bytearray()
+            encode_uvarint(number, header)
+            encode_uvarint(flags, header)
+
+    def varint_decode():
+        for frame in frames:
+            _, offset = decode_uvarint(frame, 0)
+            decode_uvarint(frame, offset)
+
+    def varint_encode_many():
+        for header in HEADERS:
+            encode_many(header, bytearray())
+
+    def varint_decode_many():
+        for frame in frames:
+            decode_many(frame, 2)
+
+    def legacy_encode():
+        for number, flags in HEADERS:
+            header = bytearray()
+            buffer, _ = legacy_put_uvarint(struct.pack('Q', number))
+            header.extend(buffer)
+            buffer, _ = legacy_put_uvarint(struct.pack('Q', flags))
+            header.extend(buffer)
+
+    def legacy_decode():
+        for frame in frames:
+            r = BytesIO(frame)
+            legacy_read_uvarint(r)
+            legacy_read_uvarint(r)
+
+    codec = PropertyCodec()
+    blocks = []
+    for properties in REV_PROPERTIES:
+        block = codec.encode(properties)
+        _, offset = decode_uvarint(block)
+        blocks.append(memoryview(block)[offset:])
+    block_bytes = sum(len(block) for block in blocks)
+
+    ## Every rev carries a distinct id and sequence, so a pull misses the block cache; clearing it models that
+    def properties_encode():
+        _encode_items.cache_clear()
+        for properties in REV_PROPERTIES:
+            codec.encode(properties)
+
+    def properties_encode_cached():
+        for properties in REV_PROPERTIES:
+            codec.encode(properties)
+
+    def properties_decode():
+        for block in blocks:
+            PropertyCodec.decode(block)
+
+    header_bytes = sum(len(frame) for frame in frames)
+    return [
+        Case("varint encode header (legacy)", legacy_encode, ops=len(HEADERS), size=header_bytes),
+        Case("varint encode header", varint_encode, ops=len(HEADERS), size=header_bytes),
+        Case("varint encode_many header", varint_encode_many, ops=len(HEADERS), size=header_bytes),
+        Case("varint decode header (legacy)", legacy_decode, ops=len(HEADERS), size=header_bytes),
+        Case("varint decode header", varint_decode, ops=len(HEADERS), size=header_bytes),
+        Case("varint decode_many header", varint_decode_many, ops=len(HEADERS), size=header_bytes),
+        Case("properties encode rev", properties_encode, ops=len(REV_PROPERTIES), size=block_bytes),
+        Case("properties encode rev (cached)", properties_encode_cached, ops=len(REV_PROPERTIES), size=block_bytes),
+        Case("properties decode rev", properties_decode, ops=len(REV_PROPERTIES), size=block_bytes),
+    ]
@@ -0,0 +1,142 @@
+##
+##
+
+import gc
+import sys
+import json
+import time
+import platform
+import tracemalloc
+from typing import Callable, List, Optional
+
+
+class Case(object):
+
+    def __init__(self, name: str, func: Callable[[], None], ops: int = 1, size: int = 0, setup: Callable[[], None] = None):
+        self.name = name
+        self.func = func
+        self.ops = ops
+        self.size = size
+        self.setup = setup
+
+
+class Result(object):
+
+    def __init__(self, name: str, ops_per_sec: float, bytes_per_sec: float, alloc_per_op: float, blocks_per_op: float):
+        self.name = name
+        self.ops_per_sec = ops_per_sec
+        self.bytes_per_sec = bytes_per_sec
+        self.alloc_per_op = alloc_per_op
+        self.blocks_per_op = blocks_per_op
+
+    @property
+    def as_dict(self):
+        return {
+            "ops_per_sec": self.ops_per_sec,
+            "bytes_per_sec": self.bytes_per_sec,
+            "alloc_per_op": self.alloc_per_op,
+            "blocks_per_op": self.blocks_per_op
+        }
+
+
+def calls_for(case: Case, min_time: float) -> int:
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            case.func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 5 or calls >= 1 << 20:
+            return max(1, int(calls * min_time / max(elapsed, 1e-9) / 5))
+        calls *= 2
+
+
+## Throughput is the best of `repeat` timed runs; allocation figures come from one extra call under tracemalloc
+## (peak bytes above the starting point, and blocks still allocated afterwards), divided by the case's op count
+def measure(case: Case, min_time: float = 0.5, repeat: int = 5) -> Result:
+    if case.setup:
+        case.setup()
+    calls = calls_for(case, min_time)
+    best = None
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(calls):
+                case.func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        case.func()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'lineno') if stat.count_diff > 0)
+
+    ops = calls * case.ops
+    return Result(case.name,
+                  ops / best,
+                  calls * case.size / best,
+                  (peak - current) / case.ops,
+                  blocks / case.ops)
+
+
+def human(value: float, unit: str = "") -> str:
+    for prefix in ("", "K", "M", "G"):
+        if abs(value) < 1000:
+            return f"{value:.1f}{prefix}{unit}"
+        value /= 1000
+    return f"{value:.1f}T{unit}"
+
+
+def report(results: List[Result], baseline: Optional[dict] = None, threshold: float = 0.1) -> List[str]:
+    regressions = []
+    header = f"{'case':<36} {'ops/s':>10} {'bytes/s':>10} {'alloc B/op':>11} {'blocks/op':>10}"
+    if baseline:
+        header += f" {'vs base':>8}"
+    print(header)
+    for result in results:
+        line = f"{result.name:<36} {human(result.ops_per_sec):>10} {human(result.bytes_per_sec, 'B'):>10} " \
+               f"{result.alloc_per_op:>11.0f} {result.blocks_per_op:>10.2f}"
+        previous = baseline.get("results", {}).get(result.name) if baseline else None
+        if previous:
+            change = result.ops_per_sec / previous["ops_per_sec"] - 1
+            line += f" {change:>+8.1%}"
+            if change < -threshold:
+                line += "  REGRESSION"
+                regressions.append(result.name)
+        print(line)
+    return regressions
+
+
+def environment() -> dict:
+    return {
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "system": platform.system()
+    }
+
+
+def save(filename: str, results: List[Result]):
+    with open(filename, 'w') as baseline_file:
+        json.dump({
+            "environment": environment(),
+            "time": int(time.time()),
+            "results": {result.name: result.as_dict for result in results}
+        }, baseline_file, indent=2)
+
+
+def load(filename: str) -> dict:
+    with open(filename, 'r') as baseline_file:
+        return json.load(baseline_file)
@@ -0,0 +1,83 @@
+##
+##
+
+from typing import List
+from pythonblip.frame import BLIPMessenger, BLIPMessage
+from pythonblip.scheduler import FrameScheduler
+from pythonblip.compression import CompressionPolicy
+from .harness import Case
+from .payloads import SMALL_DOCUMENTS, REV_PROPERTIES, MEGABYTE_JSON, MEGABYTE_BINARY
+
+
+def message(properties: dict, body: bytes, compressed: bool = False) -> BLIPMessage:
+    m = BLIPMessage(1, 0, compressed=compressed, properties=properties)
+    m.body_import(body)
+    return m
+
+
+def frames_for(messages: List[BLIPMessage]) -> List[bytes]:
+    sender = BLIPMessenger()
+    return [b''.join(sender.compose(m)) for m in messages]
+
+
+def compose_case(name: str, messages: List[BLIPMessage]) -> Case:
+    sender = BLIPMessenger()
+    size = sum(len(m.body) for m in messages)
+
+    def compose():
+        for m in messages:
+            sender.compose(m)
+
+    return Case(name, compose, ops=len(messages), size=size)
+
+
+## The CRC and inflate state run across the whole connection, so every call replays the stream into a new receiver
+def receive_case(name: str, messages: List[BLIPMessage]) -> Case:
+    frames = frames_for(messages)
+    size = sum(len(m.body) for m in messages)
+
+    def receive():
+        receiver = BLIPMessenger()
+        for frame in frames:
+            receiver.receive(frame)
+
+    return Case(name, receive, ops=len(frames), size=size)
+
+
+def multi_frame_case(name: str, body: bytes, compressed: bool = False) -> Case:
+    def transfer():
+        outbox = FrameScheduler(BLIPMessenger(compression=CompressionPolicy(threshold=0)), FrameScheduler.kFrameSize)
+        receiver = BLIPMessenger()
+        outbox.enqueue(message(REV_PROPERTIES[0], body, compressed), assign_number=True)
+        m = None
+        while True:
+            frame = outbox.next_frame()
+            if frame is None:
+                break
+            if m is None:
+                m = receiver.receive(b''.join(frame))
+            else:
+                m.extend(receiver.receive(b''.join(frame), continuation=True))
+            outbox.acknowledge(m.number, False, m.frame_total)
+
+    return Case(name, transfer, ops=1, size=len(body))
+
+
+def cases() -> List[Case]:
+    small = [message(REV_PROPERTIES[n], SMALL_DOCUMENTS[n]) for n in range(len(SMALL_DOCUMENTS))]
+    small_compressed = [message(REV_PROPERTIES[n], SMALL_DOCUMENTS[n], True) for n in range(len(SMALL_DOCUMENTS))]
+    large = [message(REV_PROPERTIES[0], MEGABYTE_BINARY)]
+    large_compressed = [message(REV_PROPERTIES[0], MEGABYTE_JSON, True)]
+
+    return [
+        compose_case("compose small json", small),
+        receive_case("receive small json", small),
+        compose_case("compose small json deflate", small_compressed),
+        receive_case("receive small json deflate", small_compressed),
+        compose_case("compose 1 MB binary", large),
+        receive_case("receive 1 MB binary", large),
+        compose_case("compose 1 MB json deflate", large_compressed),
+        receive_case("receive 1 MB json deflate", large_compressed),
+        multi_frame_case("multi-frame 1 MB binary", MEGABYTE_BINARY),
+        multi_frame_case("multi-frame 1 MB json deflate", MEGABYTE_JSON, True),
+    ]
@@ -0,0 +1,46 @@
+##
+##
+
+import json
+import atexit
+import shutil
+import tempfile
+from typing import List
+from pythonblip.output import LocalDB, LocalFile
+from .harness import Case
+from .payloads import SMALL_DOCUMENTS, MEGABYTE_BINARY
+
+kChunk = 16384
+
+
+def cases() -> List[Case]:
+    directory = tempfile.mkdtemp(prefix="pythonblip-bench-")
+    atexit.register(shutil.rmtree, directory, True)
+    documents = [json.loads(document) for document in SMALL_DOCUMENTS]
+    size = sum(len(document) for document in SMALL_DOCUMENTS)
+    local_db = LocalDB(directory).database("bench", ["_default"])
+    local_file = LocalFile(directory).database("bench", ["_default"])
+
+    def db_write():
+        for n, document in enumerate(documents):
+            local_db.write(f"doc::{n}", document)
+
+    def file_write():
+        for n, document in enumerate(documents):
+            local_file.write(f"doc::{n}", document)
+
+    def stream(output):
+        with output.open_attachment("doc::0", "application/octet-stream", len(MEGABYTE_BINARY)) as writer:
+            view = memoryview(MEGABYTE_BINARY)
+            for i in range(0, len(view), kChunk):
+                writer.write(view[i:i + kChunk])
+
+    def truncate():
+        open(local_file.jsonl_file["bench"], 'w').close()
+
+    return [
+        Case("LocalDB write small json", db_write, ops=len(documents), size=size),
+        Case("LocalFile write small json", file_write, ops=len(documents), size=size, setup=truncate),
+        Case("LocalDB attachment 1 MB", lambda: stream(local_db), ops=1, size=len(MEGABYTE_BINARY)),
+        Case("LocalFile attachment 1 MB", lambda: stream(local_file), ops=1, size=len(MEGABYTE_BINARY)),
+    ]
@@ -0,0 +1,51 @@
+##
+##
+
+import json
+import random
+
+rng = random.Random(42)
+
+
+def small_document(n: int) -> bytes:
+    return json.dumps({
+        "type": "employee",
+        "employee_id": n,
+        "name": f"Employee {n}",
+        "email": f"employee{n}@example.com",
+        "department": rng.choice(["sales", "engineering", "support", "finance"]),
+        "salary": rng.randint(40000, 200000),
+        "tags": [rng.choice(["remote", "onsite", "contractor", "manager"]) for _ in range(3)]
+    }).encode('utf-8')
+
+
+def json_body(size: int) -> bytes:
+    documents = []
+    length = 2
+    n = 0
+    while length < size:
+        document = small_document(n)
+        documents.append(document)
+        length += len(document) + 1
+        n += 1
+    return b'[' + b','.join(documents) + b']'
+
+
+def binary_body(size: int) -> bytes:
+    return rng.randbytes(size)
+
+
+def rev_properties(n: int) -> dict:
+    return {
+        "Profile": "rev",
+        "id": f"employees::{n:08d}",
+        "rev": f"1-{n:016x}",
+        "sequence": str(n + 1),
+        "collection": "0"
+    }
+
+
+SMALL_DOCUMENTS = [small_document(n) for n in range(256)]
+REV_PROPERTIES = [rev_properties(n) for n in range(1024)]
+MEGABYTE_JSON = json_body(1 << 20)
+MEGABYTE_BINARY = binary_body(1 << 20)
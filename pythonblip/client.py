@@ -1,66 +1,81 @@
 ##
 ##
-import ssl
-import time
 import logging
 import asyncio
 import websockets
 from websockets.legacy.client import WebSocketClientProtocol
 from websockets.exceptions import InvalidStatusCode, ConnectionClosed
-import multiprocessing
-from multiprocessing import Lock
 from queue import Empty
-from pythonblip.frame import MPAtomicIncrement
+from typing import Optional
+from pythonblip.handoff import FrameQueue
+from pythonblip.transport import TransportConfig
+from pythonblip.tls import shared_context
 
 logger = logging.getLogger('pythonblip.client')
 logger.addHandler(logging.NullHandler())
-sent_counter = MPAtomicIncrement()
 
 
 class BLIPClient(object):
 
-    def __init__(self, target: str, headers: dict, tls: bool = False):
-        lock = Lock()
+    def __init__(self,
+                 target: str,
+                 headers: dict,
+                 tls: bool = False,
+                 capacity: int = FrameQueue.kCapacity,
+                 transport: TransportConfig = None):
         self.headers = headers
-        self.run_loop = True
-        self.websocket = WebSocketClientProtocol()
-        self.loop = asyncio.get_event_loop()
-        self.read_queue = multiprocessing.Queue()
-        self.write_queue = multiprocessing.Queue()
-        self.run_status = multiprocessing.Value('i', 0)
-        self.run_message = multiprocessing.Array('c', 256, lock=lock)
+        self.transport = transport if transport else TransportConfig()
+        self.websocket: Optional[WebSocketClientProtocol] = None
+        self.loop = None
+        self.wakeup: Optional[asyncio.Event] = None
+        self.opened: Optional[asyncio.Event] = None
+        self.read_queue = FrameQueue(capacity)
+        self.closing = False
+        self.run_status = 0
+        self.run_message = ""
 
         if not tls:
             self.ssl_context = None
         else:
-            self.ssl_context = ssl.SSLContext()
-            self.ssl_context.check_hostname = False
-            self.ssl_context.verify_mode = ssl.CERT_NONE
-            self.ssl_context.options |= ssl.OP_NO_TLSv1
-            self.ssl_context.options |= ssl.OP_NO_TLSv1_1
-            self.ssl_context.load_default_certs()
+            self.ssl_context = shared_context()
 
         self.uri = target
 
+    ## Events are created on the loop that runs the connection; before Python 3.10 they bind to a loop when constructed
+    def bind(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.loop = loop
+            self.wakeup = asyncio.Event()
+            self.opened = asyncio.Event()
+
     async def connect(self):
-        tasks = []
+        self.bind()
         logger.debug(f"Connecting to {self.uri}")
 
         try:
+            sock = await self.transport.open(self.uri)
             connection = websockets.connect(self.uri,
+                                            sock=sock,
                                             ssl=self.ssl_context,
                                             extra_headers=self.headers,
                                             subprotocols=['BLIP_3+CBMobile_3'],
-                                            logger=logger)
+                                            logger=logger,
+                                            **self.transport.connect_options())
             async with connection as self.websocket:
-                while self.websocket.open:
-                    tasks.append(self.loop.create_task(self.reader()))
-                    tasks.append(self.loop.create_task(self.writer()))
-                    results = await asyncio.gather(*tasks, return_exceptions=True)
-                    for result in results:
-                        if isinstance(result, Exception):
-                            logger.error(f"connection: {result}")
-                            raise result
+                if sock is None:
+                    self.transport.configure(self.websocket.transport.get_extra_info('socket'))
+                self.save_session()
+                self.opened.set()
+                tasks = [self.loop.create_task(self.reader()), self.loop.create_task(self.writer())]
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in pending:
+                    task.cancel()
+                self.save_session()
+                for task in done:
+                    if task.exception():
+                        logger.error(f"connection: {task.exception()}")
+                        raise task.exception()
         except ConnectionClosed:
             return
         except InvalidStatusCode as err:
@@ -68,35 +83,76 @@ class BLIPClient(object):
         except Exception as err:
             self.handle_exception(500, str(err))
 
+    ## TLS 1.3 tickets can arrive after the handshake, so the session is captured again when the connection ends
+    def save_session(self):
+        if self.ssl_context:
+            self.ssl_context.save_session(self.websocket.transport.get_extra_info('ssl_object'))
+
     async def disconnect(self):
         logger.debug(f"Received disconnect request")
-        await self.websocket.close()
+        self.closing = True
+        self.read_queue.release()
+        if self.websocket:
+            await self.websocket.close()
 
     def handle_exception(self, code: int, message: str):
         text = (message[:256] + '..') if len(message) > 256 else message
-        self.run_status.value = code
-        self.run_message.value = text.encode('utf-8')
-        self.read_queue.put(0)
+        self.run_status = code
+        self.run_message = text
+        self.read_queue.push(0)
+
+    ## Wake the writer; safe to call from the loop thread or any other thread
+    def notify(self):
+        if self.loop is None or self.wakeup.is_set():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self.wakeup.set()
+        else:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    ## Only frames that land in the read queue count against it: after queueing one into a full queue the reader
+    ## stops taking frames off the socket, which pushes back on the peer. Responses and ACKs are consumed as read
+    def throttled(self) -> bool:
+        return not self.closing and self.read_queue.full()
 
     async def reader(self):
         try:
-            data = await asyncio.wait_for(self.websocket.recv(), timeout=0.01)
-            if data:
-                logger.debug(f"received data frame")
-                self.read_queue.put(data)
-        except asyncio.TimeoutError:
-            pass
+            async for data in self.websocket:
+                if not self.incoming(data):
+                    continue
+                while self.throttled():
+                    await self.read_queue.wait_space()
         except Exception as err:
             logger.debug(f"Reader error: {err}")
             raise
 
+    def incoming(self, data: bytes) -> bool:
+        self.read_queue.push(data)
+        return True
+
+    ## Outgoing frames come from the subclass; the protocol pulls them from its FrameScheduler
+    def next_frame(self):
+        raise Empty
+
     async def writer(self):
         try:
-            data = self.write_queue.get(block=False)
-            await self.websocket.send(data)
-            logger.debug(f"sent data frame")
-        except Empty:
-            time.sleep(0.01)
+            while True:
+                self.wakeup.clear()
+                while True:
+                    try:
+                        data = self.next_frame()
+                    except Empty:
+                        break
+                    ## One websocket frame per BLIP frame: a list would go out as a fragmented message, one masked
+                    ## frame and one write per segment, and client masking copies the payload regardless
+                    if isinstance(data, list):
+                        data = b''.join(data)
+                    await self.websocket.send(data)
+                await self.wakeup.wait()
         except Exception as err:
             logger.debug(f"Writer error: {err}")
             raise
@@ -0,0 +1,105 @@
+##
+##
+
+import math
+import time
+import zlib
+import logging
+from collections import Counter
+from typing import Callable, Any, Union
+
+logger = logging.getLogger('pythonblip.compression')
+logger.addHandler(logging.NullHandler())
+
+
+class CompressionStats(object):
+    __slots__ = ('number', 'raw_bytes', 'compressed_bytes', 'cpu_time')
+
+    def __init__(self, number: int, raw_bytes: int, compressed_bytes: int, cpu_time: float):
+        self.number = number
+        self.raw_bytes = raw_bytes
+        self.compressed_bytes = compressed_bytes
+        self.cpu_time = cpu_time
+
+    @property
+    def ratio(self) -> float:
+        return self.compressed_bytes / self.raw_bytes if self.raw_bytes else 1.0
+
+
+class CompressionPolicy(object):
+    kThreshold = 1024
+    kSampleSize = 512
+    kMaxEntropy = 7.0
+    kCompressedTypes = (
+        "image/",
+        "video/",
+        "audio/",
+        "application/zip",
+        "application/gzip",
+        "application/x-gzip",
+        "application/x-bzip2",
+        "application/x-xz",
+        "application/x-7z-compressed",
+        "application/zstd",
+    )
+
+    def __init__(self,
+                 enabled: bool = True,
+                 threshold: int = kThreshold,
+                 level: int = zlib.Z_DEFAULT_COMPRESSION,
+                 sample_size: int = kSampleSize,
+                 max_entropy: float = kMaxEntropy,
+                 report: Callable[[CompressionStats], Any] = None):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.level = level
+        self.sample_size = sample_size
+        self.max_entropy = max_entropy
+        self.report = report
+        self.messages = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.cpu_time = 0.0
+
+    @classmethod
+    def disabled(cls):
+        return cls(enabled=False)
+
+    @staticmethod
+    def entropy(sample: Union[bytes, bytearray, memoryview]) -> float:
+        total = len(sample)
+        if total == 0:
+            return 0.0
+        result = 0.0
+        for count in Counter(bytes(sample)).values():
+            p = count / total
+            result -= p * math.log2(p)
+        return result
+
+    def should_compress(self, body: Union[bytes, bytearray, memoryview], properties: dict = None) -> bool:
+        if not self.enabled or len(body) < self.threshold:
+            return False
+        c_type = properties.get("Content-Type") if properties else None
+        if c_type and c_type.startswith(self.kCompressedTypes):
+            return False
+        return self.entropy(memoryview(body)[:self.sample_size]) < self.max_entropy
+
+    @staticmethod
+    def timer() -> float:
+        return time.thread_time()
+
+    def record(self, number: int, raw_bytes: int, compressed_bytes: int, cpu_time: float) -> CompressionStats:
+        stats = CompressionStats(number, raw_bytes, compressed_bytes, cpu_time)
+        self.messages += 1
+        self.raw_bytes += raw_bytes
+        self.compressed_bytes += compressed_bytes
+        self.cpu_time += cpu_time
+        logger.debug("message #%d compressed %d to %d bytes (%.2f) in %.6f s",
+                     number, raw_bytes, compressed_bytes, stats.ratio, cpu_time)
+        if self.report:
+            self.report(stats)
+        return stats
+
+    @property
+    def ratio(self) -> float:
+        return self.compressed_bytes / self.raw_bytes if self.raw_bytes else 1.0
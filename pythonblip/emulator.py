@@ -0,0 +1,420 @@
+##
+##
+
+import json
+import base64
+import random
+import asyncio
+import logging
+import argparse
+from hashlib import sha1
+from http import HTTPStatus
+from typing import Optional, List, Tuple
+import websockets
+from websockets.exceptions import ConnectionClosed
+from .frame import BLIPMessenger, BLIPMessage, kTypeMask, kRequestType, kResponseType, kErrorType, kAckResponseType
+from .scheduler import FrameScheduler
+from .headers import BasicAuth
+
+logger = logging.getLogger('pythonblip.emulator')
+logger.addHandler(logging.NullHandler())
+
+
+class SyntheticDocument(object):
+    __slots__ = ('sequence', 'doc_id', 'rev', 'body', 'attachment')
+
+    def __init__(self, sequence: int, doc_id: str, rev: str, body: bytes, attachment: Optional[dict] = None):
+        self.sequence = sequence
+        self.doc_id = doc_id
+        self.rev = rev
+        self.body = body
+        self.attachment = attachment
+
+    @property
+    def change(self) -> list:
+        return [self.sequence, self.doc_id, self.rev]
+
+
+class SyntheticDatabase(object):
+
+    def __init__(self,
+                 name: str = "test",
+                 documents: int = 100,
+                 size: int = 512,
+                 attachments: int = 0,
+                 attachment_size: int = 65536,
+                 scope: str = "_default",
+                 collections: List[str] = None,
+                 seed: int = 0):
+        self.name = name
+        self.size = size
+        self.attachments = attachments
+        self.attachment_size = attachment_size
+        self.scope = scope
+        self.random = random.Random(seed)
+        self.sequence = 0
+        self.blobs = {}
+        self._changed: Optional[asyncio.Event] = None
+        self.collections = {}
+        for collection in collections if collections else ["_default"]:
+            self.collections[collection] = []
+            self.add(collection, documents)
+
+    def keyspace(self, collection: str) -> str:
+        return f"{self.scope}.{collection}"
+
+    def find(self, keyspace: str) -> Optional[str]:
+        for collection in self.collections:
+            if self.keyspace(collection) == keyspace:
+                return collection
+        return None
+
+    ## Every `attachments`-th document carries one attachment; bodies are padded to roughly `size` bytes
+    def add(self, collection: str, count: int):
+        documents = self.collections[collection]
+        for _ in range(count):
+            self.sequence += 1
+            index = len(documents)
+            doc_id = f"{collection}::{index:08d}"
+            body = {
+                "type": "synthetic",
+                "index": index,
+                "value": self.random.random(),
+                "data": self.random.randbytes(self.size // 2).hex()
+            }
+            attachment = None
+            if self.attachments and index % self.attachments == 0:
+                data = self.random.randbytes(self.attachment_size)
+                digest = "sha1-" + base64.b64encode(sha1(data).digest()).decode()
+                self.blobs[digest] = data
+                attachment = {"digest": digest, "length": len(data), "content_type": "application/octet-stream", "revpos": 1, "stub": True}
+                body["_attachments"] = {"blob.bin": attachment}
+            rev = f"1-{sha1(doc_id.encode()).hexdigest()[:16]}"
+            documents.append(SyntheticDocument(self.sequence, doc_id, rev, json.dumps(body).encode('utf-8'), attachment))
+        if self._changed:
+            self._changed.set()
+            self._changed = None
+
+    ## Created on first use inside the emulator's loop; before Python 3.10 an Event binds to a loop when constructed
+    @property
+    def changed(self) -> asyncio.Event:
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        return self._changed
+
+    def changes(self, collection: str, since: int) -> List[SyntheticDocument]:
+        return [document for document in self.collections[collection] if document.sequence > since]
+
+
+class EmulatorSession(object):
+
+    def __init__(self, emulator: 'BLIPEmulator', websocket):
+        self.emulator = emulator
+        self.database = emulator.database
+        self.websocket = websocket
+        self.messenger = BLIPMessenger()
+        self.wakeup = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.outbox = FrameScheduler(self.messenger, emulator.frame_size, wakeup=self.wakeup.set)
+        self.partial = {}
+        self.replies = {}
+        self.collections = ["_default"]
+        self.tasks = set()
+        self.sent_revs = 0
+
+    async def run(self):
+        writer = asyncio.get_running_loop().create_task(self.writer())
+        try:
+            async for data in self.websocket:
+                self.incoming(data)
+        except ConnectionClosed:
+            pass
+        finally:
+            writer.cancel()
+            for task in self.tasks:
+                task.cancel()
+
+    async def writer(self):
+        while True:
+            self.wakeup.clear()
+            while True:
+                frame = self.outbox.next_frame()
+                if frame is None:
+                    break
+                await self.websocket.send(b''.join(frame))
+            if len(self.outbox) <= self.emulator.kMaxQueued:
+                self.drained.set()
+            await self.wakeup.wait()
+
+    def spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.finished)
+
+    def finished(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f"emulator handler error: {task.exception()}")
+
+    def incoming(self, data: bytes):
+        number, flags, _ = BLIPMessenger.frame_header(data)
+        if BLIPMessenger.is_ack(flags):
+            m = self.messenger.receive(data)
+            self.outbox.acknowledge(m.number, m.type == kAckResponseType, m.ack_bytes)
+            return
+        key = ((flags & kTypeMask) != kRequestType, number)
+        m = self.partial.pop(key, None)
+        if m:
+            m = m.extend(self.messenger.receive(data, continuation=True))
+        else:
+            m = self.messenger.receive(data)
+        if m.more_coming:
+            self.partial[key] = m
+            return
+        if m.type == kRequestType:
+            self.spawn(self.dispatch(m))
+        else:
+            reply = self.replies.pop(m.number, None)
+            if reply and not reply.done():
+                reply.set_result(m)
+
+    def respond(self, request: BLIPMessage, properties: dict = None, body: bytes = b''):
+        if request.no_reply:
+            return
+        m = BLIPMessage(request.number, kResponseType, properties=properties if properties else {})
+        if body:
+            m.body_import(body)
+        m.compressed = self.messenger.compression.should_compress(m.body, m.properties)
+        self.outbox.enqueue(m)
+
+    def error(self, request: BLIPMessage, code: int, message: str, domain: str = "HTTP"):
+        if request.no_reply:
+            return
+        m = BLIPMessage(request.number, kErrorType, properties={"Error-Domain": domain, "Error-Code": str(code)})
+        m.body_import(message.encode('utf-8'))
+        self.outbox.enqueue(m)
+
+    def request(self, properties: dict, body: bytes = b'', no_reply: bool = False) -> Optional[asyncio.Future]:
+        m = BLIPMessage(m_type=kRequestType, no_reply=no_reply, properties=properties)
+        if body:
+            m.body_import(body)
+        m.compressed = self.messenger.compression.should_compress(m.body, properties)
+        reply = None if no_reply else asyncio.get_running_loop().create_future()
+
+        def register(message: BLIPMessage):
+            if reply:
+                self.replies[message.number] = reply
+
+        self.outbox.enqueue(m, assign_number=True, on_assign=register)
+        return reply
+
+    async def dispatch(self, m: BLIPMessage):
+        if self.emulator.latency:
+            await asyncio.sleep(self.emulator.latency)
+        profile = m.properties.get("Profile")
+        handler = getattr(self, f"handle_{profile}", None)
+        if not handler:
+            self.error(m, 404, f"no handler for BLIP request \"{profile}\"", domain="BLIP")
+            return
+        await handler(m)
+
+    def collection(self, m: BLIPMessage) -> Optional[str]:
+        index = int(m.properties.get("collection", 0))
+        if index >= len(self.collections):
+            return None
+        return self.collections[index]
+
+    async def handle_getCheckpoint(self, m: BLIPMessage):
+        checkpoint = self.emulator.checkpoints.get(self.checkpoint_key(m))
+        if not checkpoint:
+            self.error(m, 404, "missing")
+            return
+        rev, body = checkpoint
+        self.respond(m, {"rev": rev}, json.dumps(body).encode('utf-8'))
+
+    async def handle_setCheckpoint(self, m: BLIPMessage):
+        key = self.checkpoint_key(m)
+        current = self.emulator.checkpoints.get(key)
+        if current and current[0] != m.properties.get("rev", ""):
+            self.error(m, 409, "Document update conflict")
+            return
+        generation = int(current[0].split('-')[-1]) + 1 if current else 1
+        rev = f"0-{generation}"
+        self.emulator.checkpoints[key] = (rev, json.loads(m.body_as_string()))
+        self.respond(m, {"rev": rev})
+
+    def checkpoint_key(self, m: BLIPMessage) -> Tuple[str, str]:
+        return self.collection(m) if "collection" in m.properties else "_default", m.properties.get("client", "")
+
+    async def handle_getCollections(self, m: BLIPMessage):
+        request = json.loads(m.body_as_string())
+        self.collections = []
+        result = []
+        for checkpoint_id, keyspace in zip(request.get("checkpoint_ids", []), request.get("collections", [])):
+            collection = self.database.find(keyspace)
+            self.collections.append(collection)
+            if collection is None:
+                result.append(None)
+                continue
+            checkpoint = self.emulator.checkpoints.get((collection, checkpoint_id))
+            if checkpoint:
+                rev, body = checkpoint
+                result.append(dict(body, _rev=rev))
+            else:
+                result.append({})
+        self.respond(m, {}, json.dumps(result).encode('utf-8'))
+
+    async def handle_subChanges(self, m: BLIPMessage):
+        collection = self.collection(m)
+        if collection is None:
+            self.error(m, 404, "collection not found")
+            return
+        since = m.properties.get("since", 0)
+        since = int(str(since).split(':')[-1]) if since else 0
+        continuous = m.properties.get("continuous") == "true"
+        self.respond(m)
+        self.spawn(self.send_changes(m, collection, since, continuous))
+
+    ## Changes go out in batches with up to kInFlightBatches unanswered, as Sync Gateway does; each batch's revisions
+    ## follow the client's reply, and an empty batch marks the caught-up point
+    async def send_changes(self, m: BLIPMessage, collection: str, since: int, continuous: bool):
+        properties = {"Profile": "changes"}
+        if "collection" in m.properties:
+            properties["collection"] = m.properties["collection"]
+        batch_size = int(m.properties.get("batch", self.emulator.batch_size))
+        in_flight = asyncio.Semaphore(self.emulator.kInFlightBatches)
+        while True:
+            changed = self.database.changed
+            documents = self.database.changes(collection, since)
+            for i in range(0, len(documents), batch_size):
+                batch = documents[i:i + batch_size]
+                await in_flight.acquire()
+                reply = self.request(properties, json.dumps([document.change for document in batch]).encode('utf-8'))
+                self.spawn(self.send_revs(m, batch, reply, in_flight))
+                since = batch[-1].sequence
+            self.request(properties, b'[]')
+            if not continuous:
+                return
+            await changed.wait()
+
+    async def send_revs(self, m: BLIPMessage, batch: List[SyntheticDocument], reply: asyncio.Future, in_flight: asyncio.Semaphore):
+        try:
+            response = await reply
+        finally:
+            in_flight.release()
+        wants = json.loads(response.body_as_string()) if response.has_body() else []
+        for document, want in zip(batch, wants):
+            if want == 0:
+                continue
+            await self.send_rev(m, document)
+
+    async def send_rev(self, m: BLIPMessage, document: SyntheticDocument):
+        if self.emulator.drop_after and self.sent_revs >= self.emulator.drop_after:
+            self.emulator.drop_after = 0
+            logger.debug("emulator dropping connection")
+            await self.websocket.close()
+            return
+        properties = {"Profile": "rev", "id": document.doc_id, "rev": document.rev, "sequence": str(document.sequence)}
+        if "collection" in m.properties:
+            properties["collection"] = m.properties["collection"]
+        self.request(properties, document.body, no_reply=True)
+        self.sent_revs += 1
+        while len(self.outbox) > self.emulator.kMaxQueued:
+            self.drained.clear()
+            await self.drained.wait()
+
+    async def handle_getAttachment(self, m: BLIPMessage):
+        data = self.database.blobs.get(m.properties.get("digest"))
+        if data is None:
+            self.error(m, 404, "Not found")
+            return
+        self.respond(m, {}, data)
+
+
+class BLIPEmulator(object):
+    kBatchSize = 200
+    kMaxQueued = 64
+    kInFlightBatches = 4
+
+    def __init__(self,
+                 database: SyntheticDatabase = None,
+                 host: str = "127.0.0.1",
+                 port: int = 0,
+                 latency: float = 0.0,
+                 batch_size: int = kBatchSize,
+                 frame_size: int = FrameScheduler.kFrameSize,
+                 auth: BasicAuth = None,
+                 drop_after: int = 0):
+        self.database = database if database else SyntheticDatabase()
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.batch_size = batch_size
+        self.frame_size = frame_size
+        self.auth = auth
+        self.drop_after = drop_after
+        self.checkpoints = {}
+        self.connections = 0
+        self.server = None
+
+    @property
+    def target(self) -> str:
+        return f"ws://{self.host}:{self.port}/{self.database.name}/_blipsync"
+
+    async def start(self):
+        self.server = await websockets.serve(self.handler,
+                                             self.host,
+                                             self.port,
+                                             subprotocols=['BLIP_3+CBMobile_3'],
+                                             process_request=self.authenticate,
+                                             compression=None)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"emulator listening on {self.target}")
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def authenticate(self, path: str, headers):
+        if self.auth and headers.get("Authorization") != self.auth.header()["Authorization"]:
+            return HTTPStatus.UNAUTHORIZED, [], b'Login required\n'
+        return None
+
+    async def handler(self, websocket, *args):
+        self.connections += 1
+        await EmulatorSession(self, websocket).run()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-P', '--port', action='store', help="Port number", type=int, default=4984)
+    parser.add_argument('-d', '--database', action='store', help="Database name", default="test")
+    parser.add_argument('-N', '--documents', action='store', help="Documents per collection", type=int, default=1000)
+    parser.add_argument('-S', '--size', action='store', help="Document size", type=int, default=512)
+    parser.add_argument('-A', '--attachments', action='store', help="Attach a blob to every Nth document", type=int, default=0)
+    parser.add_argument('-s', '--scope', action='store', help="Scope", default="_default")
+    parser.add_argument('-c', '--collections', action='store', help="Collections")
+    parser.add_argument('-L', '--latency', action='store', help="Injected latency in seconds", type=float, default=0.0)
+    options = parser.parse_args()
+
+    async def serve():
+        database = SyntheticDatabase(options.database,
+                                     options.documents,
+                                     options.size,
+                                     options.attachments,
+                                     scope=options.scope,
+                                     collections=options.collections.split(',') if options.collections else None)
+        emulator = BLIPEmulator(database, "0.0.0.0", options.port, options.latency)
+        await emulator.start()
+        print(f"Serving {sum(len(d) for d in database.collections.values())} documents on port {emulator.port}")
+        await asyncio.Future()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
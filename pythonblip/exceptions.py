@@ -96,3 +96,14 @@ class ReplicationError(NonFatalError):
 
 class OutputError(NonFatalError):
     pass
+
+
+class VarintError(NonFatalError):
+
+    def __init__(self, message, n: int = 0):
+        self.n = n
+        super().__init__(message)
+
+
+class PropertyError(NonFatalError):
+    pass
@@ -1,45 +1,24 @@
 ##
 
 from __future__ import annotations
-import attr
 import logging
-from attr.validators import instance_of as io
+import warnings
+import threading
 from enum import Enum
-import multiprocessing
 import pythonblip.varint as binary
 from .exceptions import CRCMismatch
+## FrameDump moved to pythonblip.trace; it is re-exported so existing imports from this module keep working
+from .trace import FrameTracer, FrameDump
+from .properties import PropertyCodec, codec
+from .compression import CompressionPolicy
 import zlib
 import struct
-import json
-from io import BytesIO
+from typing import Union, List, Callable, Any, Tuple
 
 logger = logging.getLogger('pythonblip.frame')
 logger.addHandler(logging.NullHandler())
 
 
-class FrameDump:
-    def __init__(self, buffer):
-        self.buffer = buffer
-
-    def __iter__(self):
-        for i in range(0, len(self.buffer), 16):
-            block = bytearray(self.buffer[i: i + 16])
-            line = "{:08x}  {:23}  {:23}  |{:16}|".format(
-                i,
-                " ".join(("{:02x}".format(x) for x in block[:8])),
-                " ".join(("{:02x}".format(x) for x in block[8:])),
-                "".join((chr(x) if 32 <= x < 127 else "." for x in block)),
-            )
-            yield line
-        yield "{:08x}".format(len(self.buffer))
-
-    def __str__(self):
-        return "\n".join(self)
-
-    def __repr__(self):
-        return "\n".join(self)
-
-
 class MessageType(Enum):
     RequestType = 0
     ResponseType = 1
@@ -56,149 +35,229 @@ class FrameFlags(Enum):
     kMoreComing = 0x40
 
 
+kTypeMask = FrameFlags.kTypeMask.value
+kCompressed = FrameFlags.kCompressed.value
+kUrgent = FrameFlags.kUrgent.value
+kNoReply = FrameFlags.kNoReply.value
+kMoreComing = FrameFlags.kMoreComing.value
+
+kRequestType = MessageType.RequestType.value
+kResponseType = MessageType.ResponseType.value
+kErrorType = MessageType.ErrorType.value
+kAckRequestType = MessageType.AckRequestType.value
+kAckResponseType = MessageType.AckResponseType.value
+
+Segment = Union[bytes, bytearray, memoryview]
+
+
+## Deprecated: message numbers are assigned per connection by FrameScheduler. The process-wide counter is kept,
+## without multiprocessing, only for callers of the old API
 class MPAtomicIncrement(object):
 
     def __init__(self, i=1, s=1):
-        self.count = multiprocessing.Value('i', i)
+        warnings.warn("MPAtomicIncrement is deprecated; FrameScheduler numbers messages", DeprecationWarning, stacklevel=2)
+        self.lock = threading.Lock()
+        self.count = i
         self._set_size = s
-        self.set_count = multiprocessing.Value('i', s)
+        self.set_count = s
 
     def reset(self, i=1):
-        with self.count.get_lock():
-            self.count.value = i
+        with self.lock:
+            self.count = i
 
     def set_size(self, n):
-        self._set_size = n
-        with self.set_count.get_lock():
-            self.set_count.value = self._set_size
+        with self.lock:
+            self._set_size = n
+            self.set_count = n
 
     @property
     def do_increment(self):
-        with self.set_count.get_lock():
-            if self.set_count.value == 1:
-                self.set_count.value = self._set_size
+        with self.lock:
+            if self.set_count == 1:
+                self.set_count = self._set_size
                 return True
-            else:
-                self.set_count.value -= 1
-                return False
+            self.set_count -= 1
+            return False
 
     @property
     def next(self):
         if self.do_increment:
-            with self.count.get_lock():
-                current = self.count.value
-                self.count.value += 1
+            with self.lock:
+                current = self.count
+                self.count += 1
             return current
-        else:
-            return self.count.value
+        return self.count
+
+
+_message_number = None
 
 
-message_number = MPAtomicIncrement()
+def _legacy_counter() -> MPAtomicIncrement:
+    global _message_number
+    if _message_number is None:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", DeprecationWarning)
+            _message_number = MPAtomicIncrement()
+    return _message_number
+
+
+def __getattr__(name: str):
+    if name == "message_number":
+        warnings.warn("pythonblip.frame.message_number is deprecated", DeprecationWarning, stacklevel=2)
+        return _legacy_counter()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
-@attr.s
 class BLIPMessage(object):
-    number = attr.ib(validator=io(int))
-    type = attr.ib(validator=io(int))
-    compressed = attr.ib(validator=io(bool))
-    urgent = attr.ib(validator=io(bool))
-    no_reply = attr.ib(validator=io(bool))
-    more_coming = attr.ib(validator=io(bool))
-    properties = attr.ib(validator=io(dict))
-    body = attr.ib(validator=io(bytearray))
-    frame_size = attr.ib(validator=io(int))
-    ack_bytes = attr.ib(validator=io(int))
+    __slots__ = ('number', 'type', 'flags', 'properties', 'body', 'frame_size', 'ack_bytes', 'sink')
+
+    def __init__(self,
+                 number: int = 0,
+                 m_type: int = 0,
+                 compressed: bool = False,
+                 urgent: bool = False,
+                 no_reply: bool = False,
+                 more_coming: bool = False,
+                 properties: dict = None,
+                 body: Union[bytearray, memoryview] = None,
+                 frame_size: int = 0,
+                 ack_bytes: int = 0,
+                 sink: Callable[[memoryview], Any] = None):
+        self.number = number
+        self.type = m_type & kTypeMask
+        self.flags = m_type & ~kTypeMask
+        self.properties = properties if properties is not None else {}
+        self.body = body if body is not None else bytearray()
+        self.frame_size = frame_size
+        self.ack_bytes = ack_bytes
+        self.sink = sink
+        if compressed:
+            self.flags |= kCompressed
+        if urgent:
+            self.flags |= kUrgent
+        if no_reply:
+            self.flags |= kNoReply
+        if more_coming:
+            self.flags |= kMoreComing
+
+    def __repr__(self):
+        return f"BLIPMessage(number={self.number}, type={self.type}, flags=0x{self.flags:02x}, " \
+               f"properties={self.properties}, length={len(self.body)})"
 
     @classmethod
     def construct(cls):
-        return cls(
-            0,
-            0,
-            False,
-            False,
-            False,
-            False,
-            {},
-            bytearray(),
-            0,
-            0
-        )
+        return cls()
+
+    def _set_flag(self, flag: int, value: bool):
+        if value:
+            self.flags |= flag
+        else:
+            self.flags &= ~flag
+
+    @property
+    def compressed(self) -> bool:
+        return self.flags & kCompressed != 0
+
+    @compressed.setter
+    def compressed(self, value: bool):
+        self._set_flag(kCompressed, value)
+
+    @property
+    def urgent(self) -> bool:
+        return self.flags & kUrgent != 0
+
+    @urgent.setter
+    def urgent(self, value: bool):
+        self._set_flag(kUrgent, value)
+
+    @property
+    def no_reply(self) -> bool:
+        return self.flags & kNoReply != 0
+
+    @no_reply.setter
+    def no_reply(self, value: bool):
+        self._set_flag(kNoReply, value)
+
+    @property
+    def more_coming(self) -> bool:
+        return self.flags & kMoreComing != 0
+
+    @more_coming.setter
+    def more_coming(self, value: bool):
+        self._set_flag(kMoreComing, value)
+
+    @property
+    def frame_flags(self) -> int:
+        return self.type | self.flags
 
     def set_number(self, n: int):
         self.number = n
 
     def next_number(self):
-        self.number = message_number.next
+        warnings.warn("BLIPMessage.next_number() is deprecated; FrameScheduler numbers messages", DeprecationWarning, stacklevel=2)
+        self.number = _legacy_counter().next
 
     def set_type(self, n: int):
-        self.type = MessageType(n & FrameFlags.kTypeMask.value).value
+        self.type = n & kTypeMask
 
     def set_flags(self, n: int):
-        if n & FrameFlags.kUrgent.value != 0:
-            self.urgent = True
-        if n & FrameFlags.kCompressed.value != 0:
-            self.compressed = True
-        if n & FrameFlags.kNoReply.value != 0:
-            self.no_reply = True
-        if n & FrameFlags.kMoreComing.value != 0:
-            self.more_coming = True
+        self.flags |= n & ~kTypeMask
 
     def compute_flag(self, n: int):
-        self.type = self.type | n
-        if self.urgent:
-            self.type = self.type | FrameFlags.kUrgent.value
-        if self.compressed:
-            self.type = self.type | FrameFlags.kCompressed.value
-        if self.no_reply:
-            self.type = self.type | FrameFlags.kNoReply.value
-        if self.more_coming:
-            self.type = self.type | FrameFlags.kMoreComing.value
+        self.type |= n & kTypeMask
+        self.flags |= n & ~kTypeMask
 
     def set_ack_bytes(self, n: int):
         self.ack_bytes = n
 
     def body_as_string(self):
-        return self.body.decode('utf-8')
+        return str(self.body, 'utf-8')
 
     def body_as_bytes(self) -> bytes:
         return bytes(self.body)
 
-    def body_import(self, data: bytes):
-        self.body.extend(data)
-        self.frame_size += len(data) + 4
+    def stream_to(self, sink: Callable[[memoryview], Any]):
+        self.sink = sink
+        if len(self.body) > 0:
+            sink(memoryview(self.body))
+            self.body = bytearray()
+
+    def body_import(self, data: Union[bytes, bytearray, memoryview]):
+        if self.sink:
+            self.sink(data)
+        elif len(self.body) == 0 and isinstance(data, memoryview):
+            self.body = data
+        else:
+            if not isinstance(self.body, bytearray):
+                self.body = bytearray(self.body)
+            self.body.extend(data)
 
     def has_body(self) -> bool:
         return len(self.body) > 0
 
+    ## Deprecated: properties are encoded and decoded by BLIPMessenger with its own PropertyCodec
     def prop_string(self):
-        prop_string = ""
-        for key in self.properties:
-            begin = '\0' if len(prop_string) > 0 else ""
-            prop_string = f"{prop_string}{begin}{key}\0{self.properties[key]}"
-        prop_string = f"{prop_string}\0"
-        return prop_string.encode('utf-8'), len(prop_string)
+        warnings.warn("BLIPMessage.prop_string() is deprecated; use BLIPMessenger", DeprecationWarning, stacklevel=2)
+        return self.prop_block()
 
     def prop_encode(self):
-        s = json.dumps(self.properties, separators=('\0', '\0')).encode('utf-8')
-        s = s.replace(b'\x22', b'')
-        s = s.replace(b'\x7b', b'')
-        s = s.replace(b'\x7d', b'')
-        s = s + b'\x00'
-        return s, len(s)
-
-    def prop_import(self, data: bytes):
-        data = data.rstrip(b'\0')
-        prop_list = data.split(b'\0')
-        for k, v in zip(*[iter(prop_list)]*2):
-            self.properties[k.decode('utf-8')] = v.decode('utf-8')
+        warnings.warn("BLIPMessage.prop_encode() is deprecated; use BLIPMessenger", DeprecationWarning, stacklevel=2)
+        return self.prop_block()
+
+    def prop_import(self, data: Union[bytes, memoryview]):
+        warnings.warn("BLIPMessage.prop_import() is deprecated; use BLIPMessenger", DeprecationWarning, stacklevel=2)
+        self.properties.update(codec.decode(data))
+
+    def prop_block(self) -> Tuple[bytes, int]:
+        block = codec.encode(self.properties)
+        _, offset = binary.decode_uvarint(block)
+        return block[offset:], len(block) - offset
 
     def extend(self, m: BLIPMessage):
         self.type = m.type
-        self.urgent = m.urgent
-        self.compressed = m.compressed
-        self.more_coming = m.more_coming
-        self.no_reply = m.no_reply
+        self.flags = m.flags
         self.body_import(m.body)
+        self.frame_size += m.frame_size
         return self
 
     def frame_extend(self, n):
@@ -210,65 +269,115 @@ class BLIPMessage(object):
 
     @property
     def as_dict(self):
-        return self.__dict__
+        return {
+            "number": self.number,
+            "type": self.type,
+            "compressed": self.compressed,
+            "urgent": self.urgent,
+            "no_reply": self.no_reply,
+            "more_coming": self.more_coming,
+            "properties": self.properties,
+            "body": self.body,
+            "frame_size": self.frame_size,
+            "ack_bytes": self.ack_bytes
+        }
 
 
 class BLIPMessenger(object):
     DEFLATE_TRAILER = b"\x00\x00\xff\xff"
     kAckInterval = 50000
     kMaxUnackedBytes = 128000
-
-    def __init__(self):
-        self.messages_number = MPAtomicIncrement()
+    kMergeLimit = 4096
+
+    def __init__(self,
+                 trace_size: int = FrameTracer.kRingSize,
+                 tokenize: bool = False,
+                 compression: CompressionPolicy = None):
+        self.codec = PropertyCodec(tokenize)
+        self.tracer = FrameTracer(trace_size)
+        self.compression = compression if compression else CompressionPolicy()
         self.buffer = bytearray()
         self.unzip = zlib.decompressobj(-zlib.MAX_WBITS)
-        self.zip = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        self.zip = zlib.compressobj(self.compression.level, wbits=-zlib.MAX_WBITS)
         self.s_crc = 0
         self.r_crc = 0
 
-    def compose(self, m: BLIPMessage):
-        header = 0
-        message = bytearray()
-
-        buffer, n = binary.put_uvarint(binary.uint64(m.number))
-        message.extend(buffer)
-        header += n
-        buffer, n = binary.put_uvarint(binary.uint64(m.type))
-        message.extend(buffer)
-        header += n
-
-        if (m.type & 0x07) == MessageType.AckResponseType.value:
-            buffer, n = binary.put_uvarint(binary.uint64(m.ack_bytes))
-            message.extend(buffer)
-            return message
-
-        prop_string, prop_length = m.prop_encode()
-        buffer, _ = binary.put_uvarint(binary.uint64(prop_length))
-        message.extend(buffer)
-        message.extend(prop_string)
-
+    def payload(self, m: BLIPMessage) -> List[Segment]:
+        segments: List[Segment] = [self.codec.encode(m.properties)]
         if m.has_body():
-            message.extend(m.body)
+            segments.append(memoryview(m.body))
+        return segments
 
-        self.s_crc = zlib.crc32(message[header:], self.s_crc)
+    def compose(self, m: BLIPMessage) -> List[Segment]:
+        if self.is_ack(m.type):
+            header = bytearray()
+            binary.encode_uvarint(m.number, header)
+            binary.encode_uvarint(m.frame_flags, header)
+            binary.encode_uvarint(m.ack_bytes, header)
+            return [header]
 
-        if m.compressed:
-            deflated_full = self.zip.compress(message[header:])
-            deflated = deflated_full[:len(deflated_full) - 4]
-            message[header:] = deflated
+        return self.compose_frame(m, self.payload(m))
 
-        message.extend(struct.pack('>I', self.s_crc))
+    def compose_frame(self, m: BLIPMessage, segments: List[Segment], more_coming: bool = False) -> List[Segment]:
+        header = bytearray()
+        flags = m.frame_flags | kMoreComing if more_coming else m.frame_flags
 
-        for line in FrameDump(message):
-            logger.debug(line)
+        binary.encode_uvarint(m.number, header)
+        binary.encode_uvarint(flags, header)
 
-        return message
+        for segment in segments:
+            self.s_crc = zlib.crc32(segment, self.s_crc)
 
-    def error_frame(self, code: int, e_type: str, message: str):
+        if m.compressed:
+            raw_bytes = sum(len(segment) for segment in segments)
+            start = self.compression.timer()
+            segments = self.deflate(segments)
+            cpu_time = self.compression.timer() - start
+            self.compression.record(m.number, raw_bytes, sum(len(segment) for segment in segments), cpu_time)
+        else:
+            segments = list(segments)
+
+        ## The header absorbs a small leading segment (the property block) and a small trailing segment absorbs the CRC,
+        ## so a frame is one or two segments; large body slices are passed through uncopied
+        crc = struct.pack('>I', self.s_crc)
+        if segments and len(segments[0]) <= self.kMergeLimit:
+            header += segments[0]
+            segments[0] = header
+        else:
+            segments.insert(0, header)
+        if len(segments) > 1 and len(segments[-1]) <= self.kMergeLimit:
+            segments[-1] = b''.join((segments[-1], crc))
+        elif len(segments) == 1:
+            header += crc
+        else:
+            segments.append(crc)
+
+        if self.tracer.enabled:
+            self.tracer.record("sent", m.number, flags, segments)
+
+        return segments
+
+    def deflate(self, segments: List[Segment]) -> List[Segment]:
+        deflated: List[Segment] = []
+        for segment in segments:
+            block = self.zip.compress(segment)
+            if block:
+                deflated.append(block)
+        block = self.zip.flush(zlib.Z_SYNC_FLUSH)
+        deflated.append(memoryview(block)[:-len(BLIPMessenger.DEFLATE_TRAILER)])
+        return deflated
+
+    ## An error is the reply to a request, so it carries that request's number. The old three-argument form,
+    ## error_frame(code, e_type, message), still works but is deprecated and numbers the error from the legacy counter
+    def error_frame(self, number: int, code: int, e_type: str, message: str = None):
+        if message is None:
+            warnings.warn("error_frame(code, e_type, message) is deprecated; pass the request number first",
+                          DeprecationWarning, stacklevel=2)
+            number, code, e_type, message = _legacy_counter().next, number, code, e_type
         m = BLIPMessage.construct()
 
-        m.next_number()
-        m.set_type(2)
+        m.set_number(number)
+        m.set_type(kErrorType)
         m.set_flags(0)
         m.properties = {
             "Error-Domain": e_type,
@@ -278,53 +387,62 @@ class BLIPMessenger(object):
 
         return self.compose(m)
 
-    def receive(self, message: bytearray, continuation: bool = False) -> BLIPMessage:
-        m = BLIPMessage.construct()
-        header = 0
-        total = len(message)
+    @staticmethod
+    def frame_header(message: Union[bytes, bytearray, memoryview]) -> Tuple[int, int, int]:
+        message_num, offset = binary.decode_uvarint(message, 0)
+        flags, offset = binary.decode_uvarint(message, offset)
+        return message_num, flags, offset
 
-        for line in FrameDump(message):
-            logger.debug(line)
+    @staticmethod
+    def is_ack(flags: int) -> bool:
+        m_type = flags & kTypeMask
+        return m_type == kAckRequestType or m_type == kAckResponseType
 
-        r = BytesIO(message)
+    ## frame_size is the raw length of the received frame, the byte count ACKs report to the sender
+    def receive(self, message: Union[bytes, bytearray], continuation: bool = False) -> BLIPMessage:
+        m = BLIPMessage.construct()
+        view = memoryview(message)
+        total = len(view)
+        m.frame_size = total
 
-        message_num, n = binary.read_uvarint(r)
-        header += n
-        flags, n = binary.read_uvarint(r)
-        header += n
+        message_num, flags, header = self.frame_header(view)
 
         m.set_number(message_num)
         m.set_type(flags)
         m.set_flags(flags)
 
+        if self.tracer.enabled:
+            self.tracer.record("received", message_num, flags, bytes(message))
+
+        if self.is_ack(flags):
+            ack_bytes, _ = binary.decode_uvarint(view, header)
+            m.set_ack_bytes(ack_bytes)
+            return m
+
+        payload = view[header:total - 4]
         if m.compressed:
-            logger.debug("received compressed frame")
-            compressed_block = message[header:total - 4]
-            compressed_block = compressed_block + BLIPMessenger.DEFLATE_TRAILER
-            inflated = self.unzip.decompress(compressed_block)
+            inflated = self.unzip.decompress(payload)
+            tail = self.unzip.decompress(BLIPMessenger.DEFLATE_TRAILER)
+            if tail:
+                inflated += tail
             self.r_crc = zlib.crc32(inflated, self.r_crc)
-            inflated = inflated + message[-4:]
-            r = BytesIO(inflated)
-            for line in FrameDump(inflated):
-                logger.debug(line)
+            payload = memoryview(inflated)
         else:
-            self.r_crc = zlib.crc32(message[header:total - 4], self.r_crc)
+            self.r_crc = zlib.crc32(payload, self.r_crc)
 
+        offset = 0
         if not continuation:
-            prop_len, n = binary.read_uvarint(r)
-            m.frame_extend(n + prop_len)
-            prop_data = r.read(prop_len)
-            m.prop_import(prop_data)
+            prop_len, offset = binary.decode_uvarint(payload, 0)
+            m.properties = self.codec.decode(payload[offset:offset + prop_len])
+            offset += prop_len
 
-        remainder = r.getbuffer().nbytes - r.tell()
-        if remainder > 4:
-            body = r.read(remainder - 4)
-            m.body_import(body)
+        if len(payload) > offset:
+            m.body_import(payload[offset:])
 
-        message_sum = r.read(4)
-        r_crc = struct.unpack('>I', message_sum)
+        r_crc = struct.unpack_from('>I', view, total - 4)
 
         if r_crc[0] != self.r_crc:
+            self.tracer.dump()
             raise CRCMismatch(f"message {message_num} CRC mismatch")
 
         return m
@@ -0,0 +1,109 @@
+##
+##
+
+import asyncio
+import logging
+import threading
+from collections import deque
+from queue import Empty
+from typing import Any
+
+logger = logging.getLogger('pythonblip.handoff')
+logger.addHandler(logging.NullHandler())
+
+
+class FrameQueue(object):
+    kCapacity = 1024
+
+    def __init__(self, capacity: int = kCapacity):
+        self.capacity = capacity
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.space_waiters = deque()
+        self.item_waiters = deque()
+        self.released = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def qsize(self) -> int:
+        return len(self.items)
+
+    def empty(self) -> bool:
+        return not self.items
+
+    def full(self) -> bool:
+        return 0 < self.capacity <= len(self.items)
+
+    ## The loop side never blocks: items, passed by reference with nothing copied or pickled, are always accepted, and
+    ## the producer awaits wait_space() afterwards to hold back while the queue is full
+    def push(self, item: Any):
+        with self.lock:
+            self.items.append(item)
+            self.not_empty.notify()
+            self.release_items()
+
+    def get(self, block: bool = True, timeout: float = None) -> Any:
+        with self.not_empty:
+            if not self.items:
+                if not block:
+                    raise Empty
+                if not self.not_empty.wait_for(lambda: self.items, timeout):
+                    raise Empty
+            item = self.items.popleft()
+            self.release_space()
+        return item
+
+    def get_nowait(self) -> Any:
+        return self.get(block=False)
+
+    async def get_async(self, timeout: float = None) -> Any:
+        loop = asyncio.get_running_loop()
+        end = None if timeout is None else loop.time() + timeout
+        while True:
+            with self.lock:
+                if self.items:
+                    item = self.items.popleft()
+                    self.release_space()
+                    return item
+                waiter = loop.create_future()
+                self.item_waiters.append(waiter)
+            remaining = None if end is None else end - loop.time()
+            if remaining is not None and remaining <= 0:
+                raise Empty
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                raise Empty
+
+    def release_space(self):
+        while self.space_waiters:
+            waiter = self.space_waiters.popleft()
+            waiter.get_loop().call_soon_threadsafe(self.wake, waiter)
+
+    def release_items(self):
+        while self.item_waiters:
+            waiter = self.item_waiters.popleft()
+            waiter.get_loop().call_soon_threadsafe(self.wake, waiter)
+
+    ## Return tasks parked in wait_space() even though the queue is still full, so they re-check why they wait
+    def release(self):
+        with self.lock:
+            self.released += 1
+            self.release_space()
+
+    @staticmethod
+    def wake(waiter: asyncio.Future):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    async def wait_space(self):
+        released = self.released
+        while True:
+            with self.lock:
+                if not self.full() or self.released != released:
+                    return
+                waiter = asyncio.get_running_loop().create_future()
+                self.space_waiters.append(waiter)
+            await waiter
@@ -7,12 +7,138 @@ import re
 from typing import Union
 import mimetypes
 import logging
+import threading
 from .exceptions import OutputError
 
 logger = logging.getLogger('pythonblip.output')
 logger.addHandler(logging.NullHandler())
 
 
+class AttachmentWriter(object):
+
+    def __init__(self, doc_id: str, c_type: str, collection: str = None):
+        self.doc_id = doc_id
+        self.c_type = c_type
+        self.collection = collection
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+
+    def write(self, data: Union[bytes, memoryview]):
+        self.size += len(data)
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class BlobAttachment(AttachmentWriter):
+
+    def __init__(self, db: 'LocalDB', name: str, doc_id: str, c_type: str, length: int, collection: str = None):
+        super().__init__(doc_id, c_type, collection)
+        self.db = db
+        self.name = name
+        self.con = db.db_files[name]["con"]
+        self.length = length
+        self.blob = None
+        self.buffer = None
+        if hasattr(self.con, 'blobopen') and length:
+            with db.lock:
+                cur = self.con.execute("INSERT OR REPLACE INTO attachments VALUES (?, ?, zeroblob(?))", (doc_id, c_type, length))
+                self.blob = self.con.blobopen('attachments', 'data', cur.lastrowid)
+                db.blob_opened(name)
+        else:
+            self.buffer = bytearray()
+
+    def write(self, data: Union[bytes, memoryview]):
+        try:
+            if self.blob and self.size + len(data) > self.length:
+                self.spill()
+            if self.blob:
+                with self.db.lock:
+                    self.blob.write(data)
+            else:
+                self.buffer.extend(data)
+        except Exception as err:
+            raise OutputError(f"can not write attachment {self.doc_id}: {err}")
+        super().write(data)
+
+    ## The row was sized from the advertised length; a body that turns out longer or shorter is moved to the buffer
+    ## and the row is rewritten on close, so it neither overflows the blob nor ends in zero padding
+    def spill(self):
+        logger.warning(f"Attachment {self.doc_id} length does not match the advertised {self.length} bytes")
+        with self.db.lock:
+            self.blob.seek(0)
+            self.buffer = bytearray(self.blob.read(self.size))
+            self.blob.close()
+            self.blob = None
+            self.db.blob_closed(self.name)
+
+    def close(self):
+        if self.blob and self.size != self.length:
+            try:
+                self.spill()
+            except Exception as err:
+                raise OutputError(f"can not write attachment {self.doc_id}: {err}")
+        with self.db.lock:
+            if self.blob:
+                self.blob.close()
+                self.blob = None
+                self.db.blob_closed(self.name)
+            else:
+                self.con.execute("INSERT OR REPLACE INTO attachments VALUES (?, ?, ?)", (self.doc_id, self.c_type, self.buffer))
+                self.db.commit(self.name)
+
+    def abort(self):
+        with self.db.lock:
+            if self.blob:
+                self.blob.close()
+                self.blob = None
+                self.con.execute("DELETE FROM attachments WHERE doc_id = ?", (self.doc_id,))
+                self.db.blob_closed(self.name)
+
+
+class FileAttachment(AttachmentWriter):
+
+    def __init__(self, filename: str, doc_id: str, c_type: str, collection: str = None):
+        super().__init__(doc_id, c_type, collection)
+        self.filename = filename
+        try:
+            self.data_file = open(filename, 'wb')
+        except Exception as err:
+            raise OutputError(f"can not write to file: {err}")
+
+    def write(self, data: Union[bytes, memoryview]):
+        try:
+            self.data_file.write(data)
+        except Exception as err:
+            raise OutputError(f"can not write to file: {err}")
+        super().write(data)
+
+    def close(self):
+        self.data_file.close()
+
+    def abort(self):
+        self.data_file.close()
+        os.remove(self.filename)
+
+
+class ScreenAttachment(AttachmentWriter):
+
+    def close(self):
+        logger.debug(f"Screen Output: Attachment {self.doc_id} from {self.collection}")
+        print(f"Attachment from document {self.doc_id} of type {self.c_type} length {self.size}")
+
+
 class LocalDB(object):
 
     def __init__(self, directory: str = None):
@@ -24,6 +150,7 @@ class LocalDB(object):
         self.db_file = None
         self.con = None
         self.cur = None
+        self.lock = threading.RLock()
 
         if not os.access(self.directory, os.W_OK):
             raise OutputError(f"Directory {self.directory} is not writable")
@@ -34,8 +161,9 @@ class LocalDB(object):
             name = collection if collection != "_default" else database
             self.db_files[name] = {}
             self.db_files[name]["db_file"] = f"{self.directory}/{name}.db"
-            self.db_files[name]["con"] = sqlite3.connect(self.db_files[name]["db_file"])
+            self.db_files[name]["con"] = sqlite3.connect(self.db_files[name]["db_file"], check_same_thread=False)
             self.db_files[name]["cur"] = self.db_files[name]["con"].cursor()
+            self.db_files[name]["blobs"] = 0
 
             self.db_files[name]["cur"].execute('''
                CREATE TABLE IF NOT EXISTS documents(
@@ -56,13 +184,34 @@ class LocalDB(object):
         name = collection if collection and collection != "_default" else self._database
         if type(document) == dict:
             document = json.dumps(document)
-        self.db_files[name]["cur"].execute("INSERT OR REPLACE INTO documents VALUES (?, ?)", (doc_id, document))
-        self.db_files[name]["con"].commit()
+        with self.lock:
+            self.db_files[name]["cur"].execute("INSERT OR REPLACE INTO documents VALUES (?, ?)", (doc_id, document))
+            self.commit(name)
 
     def write_attachment(self, doc_id: str, c_type: str, data: bytes, collection: str = None):
         name = collection if collection and collection != "_default" else self._database
-        self.db_files[name]["cur"].execute("INSERT OR REPLACE INTO attachments VALUES (?, ?, ?)", (doc_id, c_type, data))
-        self.db_files[name]["con"].commit()
+        with self.lock:
+            self.db_files[name]["cur"].execute("INSERT OR REPLACE INTO attachments VALUES (?, ?, ?)", (doc_id, c_type, data))
+            self.commit(name)
+
+    def open_attachment(self, doc_id: str, c_type: str, length: int = 0, collection: str = None) -> BlobAttachment:
+        name = collection if collection and collection != "_default" else self._database
+        return BlobAttachment(self, name, doc_id, c_type, length, collection)
+
+    ## SQLite refuses to commit while a blob handle is open, so commits are deferred until the last one closes
+    def commit(self, name: str):
+        with self.lock:
+            if self.db_files[name]["blobs"] == 0:
+                self.db_files[name]["con"].commit()
+
+    def blob_opened(self, name: str):
+        with self.lock:
+            self.db_files[name]["blobs"] += 1
+
+    def blob_closed(self, name: str):
+        with self.lock:
+            self.db_files[name]["blobs"] -= 1
+            self.commit(name)
 
 
 class LocalFile(object):
@@ -99,11 +248,14 @@ class LocalFile(object):
         except Exception as err:
             raise OutputError(f"can not write to file: {err}")
 
-    def write_attachment(self, doc_id: str, c_type: str, data: bytes, collection: str = None):
+    def attachment_file(self, doc_id: str, c_type: str, collection: str = None) -> str:
         name = collection if collection and collection != "_default" else self._database
         extension = mimetypes.guess_all_extensions(c_type)[0]
         file_prefix = re.sub(r'[#%&{}<>*?$!:@+|=\\/\'\s`\"]', '_', doc_id).strip().lower()
-        filename = f"{self.directory}/{name}_{file_prefix}{extension}"
+        return f"{self.directory}/{name}_{file_prefix}{extension}"
+
+    def write_attachment(self, doc_id: str, c_type: str, data: bytes, collection: str = None):
+        filename = self.attachment_file(doc_id, c_type, collection)
         try:
             with open(filename, 'wb') as data_file:
                 data_file.write(data)
@@ -111,6 +263,9 @@ class LocalFile(object):
         except Exception as err:
             raise OutputError(f"can not write to file: {err}")
 
+    def open_attachment(self, doc_id: str, c_type: str, length: int = 0, collection: str = None) -> FileAttachment:
+        return FileAttachment(self.attachment_file(doc_id, c_type, collection), doc_id, c_type, collection)
+
 
 class ScreenOutput(object):
 
@@ -135,3 +290,7 @@ class ScreenOutput(object):
     def write_attachment(doc_id: str, c_type: str, data: bytes, collection: str = None):
         logger.debug(f"Screen Output: Attachment {doc_id} from {collection}")
         print(f"Attachment from document {doc_id} of type {c_type} length {len(data)}")
+
+    @staticmethod
+    def open_attachment(doc_id: str, c_type: str, length: int = 0, collection: str = None) -> ScreenAttachment:
+        return ScreenAttachment(doc_id, c_type, collection)
@@ -0,0 +1,143 @@
+##
+##
+
+import asyncio
+import logging
+from collections import deque
+from typing import Optional, Tuple
+from .protocol import AsyncBLIPProtocol
+from .reactor import Reactor
+
+logger = logging.getLogger('pythonblip.pool')
+logger.addHandler(logging.NullHandler())
+
+
+class PooledConnection(object):
+    __slots__ = ('key', 'protocol', 'released', 'timer')
+
+    def __init__(self, key: Tuple, protocol: AsyncBLIPProtocol):
+        self.key = key
+        self.protocol = protocol
+        self.released = 0.0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class ConnectionPool(object):
+    kMaxIdle = 300.0
+    kMaxSize = 4
+    kPingAfter = 30.0
+    kPingTimeout = 5.0
+
+    def __init__(self,
+                 max_idle: float = kMaxIdle,
+                 max_size: int = kMaxSize,
+                 ping_after: float = kPingAfter,
+                 reactor: Reactor = None):
+        self.max_idle = max_idle
+        self.max_size = max_size
+        self.ping_after = ping_after
+        self._reactor = reactor
+        self.idle = {}
+        self.active = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.hits = 0
+        self.misses = 0
+
+    ## Synchronous replicators run their pooled connections on this reactor
+    @property
+    def reactor(self) -> Reactor:
+        if not self._reactor:
+            self._reactor = Reactor.shared()
+        return self._reactor
+
+    @staticmethod
+    def key(target: str, headers: dict, tls: bool) -> Tuple:
+        return target, tuple(sorted(headers.items())), tls
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.idle.values())
+
+    def bind(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is None:
+            self.loop = loop
+        elif self.loop is not loop:
+            raise RuntimeError("connection pool used from more than one event loop")
+
+    @staticmethod
+    def healthy(protocol: AsyncBLIPProtocol) -> bool:
+        return protocol.connection is not None \
+            and not protocol.connection.done() \
+            and protocol.websocket is not None \
+            and protocol.websocket.open \
+            and protocol.run_status == 0 \
+            and not protocol.pending \
+            and not protocol.partial \
+            and protocol.read_queue.empty()
+
+    async def alive(self, entry: PooledConnection) -> bool:
+        if not self.healthy(entry.protocol):
+            return False
+        if self.loop.time() - entry.released < self.ping_after:
+            return True
+        try:
+            pong = await entry.protocol.websocket.ping()
+            await asyncio.wait_for(pong, self.kPingTimeout)
+            return True
+        except Exception as err:
+            logger.debug(f"pooled connection to {entry.key[0]} failed ping: {err}")
+            return False
+
+    async def acquire(self, target: str, headers: dict, tls: bool = False, **kwargs) -> AsyncBLIPProtocol:
+        self.bind()
+        key = self.key(target, headers, tls)
+        entries = self.idle.get(key)
+        while entries:
+            entry = entries.pop()
+            entry.timer.cancel()
+            if await self.alive(entry):
+                self.hits += 1
+                self.active[id(entry.protocol)] = entry
+                logger.debug(f"reusing pooled connection to {target}")
+                return entry.protocol
+            await self.discard(entry)
+
+        self.misses += 1
+        protocol = AsyncBLIPProtocol(target, headers, tls, **kwargs)
+        await protocol.start()
+        self.active[id(protocol)] = PooledConnection(key, protocol)
+        return protocol
+
+    async def release(self, protocol: AsyncBLIPProtocol, discard: bool = False):
+        entry = self.active.pop(id(protocol), None)
+        if not entry:
+            await protocol.stop()
+            return
+        entries = self.idle.setdefault(entry.key, deque())
+        if discard or not self.healthy(protocol) or len(entries) >= self.max_size:
+            await self.discard(entry)
+            return
+        entry.released = self.loop.time()
+        entry.timer = self.loop.call_later(self.max_idle, self.expire, entry)
+        entries.append(entry)
+
+    def expire(self, entry: PooledConnection):
+        entries = self.idle.get(entry.key)
+        if entries and entry in entries:
+            entries.remove(entry)
+            logger.debug(f"closing idle connection to {entry.key[0]}")
+            self.loop.create_task(entry.protocol.stop())
+
+    @staticmethod
+    async def discard(entry: PooledConnection):
+        try:
+            await entry.protocol.stop()
+        except Exception as err:
+            logger.debug(f"error closing pooled connection: {err}")
+
+    async def close(self):
+        entries = [entry for queue in self.idle.values() for entry in queue]
+        self.idle = {}
+        for entry in entries:
+            entry.timer.cancel()
+            await self.discard(entry)
@@ -0,0 +1,119 @@
+##
+##
+
+import sys
+from functools import lru_cache
+from typing import Tuple, Union
+import pythonblip.varint as binary
+from .exceptions import PropertyError
+
+kMaxInternedKeys = 1024
+kCacheSize = 256
+
+kSpecialProperties = [
+    "Profile",
+    "Error-Code",
+    "Error-Domain",
+    "Content-Type",
+    "application/json",
+    "application/octet-stream",
+    "text/plain; charset=UTF-8",
+    "text/xml",
+    "Accept",
+    "Cache-Control",
+    "must-revalidate",
+    "If-Match",
+    "If-None-Match",
+    "Location",
+]
+
+TOKENS = {s: chr(n + 1) for n, s in enumerate(kSpecialProperties)}
+TOKEN_VALUES = {n + 1: s for n, s in enumerate(kSpecialProperties)}
+
+_property_keys = {}
+
+
+def intern_key(k: bytes) -> str:
+    key = _property_keys.get(k)
+    if key is None:
+        key = sys.intern(k.decode('utf-8'))
+        if len(_property_keys) < kMaxInternedKeys:
+            _property_keys[k] = key
+    return key
+
+
+def property_text(v) -> str:
+    if v is True:
+        return "true"
+    if v is False:
+        return "false"
+    return v if type(v) is str else str(v)
+
+
+@lru_cache(maxsize=kCacheSize)
+def _encode_items(items: Tuple[str, ...], tokenize: bool) -> bytes:
+    output = bytearray()
+    if not items:
+        binary.encode_uvarint(0, output)
+        return bytes(output)
+    for s in items:
+        if '\0' in s:
+            raise PropertyError(f"property {s!r} contains a NUL character")
+    if tokenize:
+        items = tuple(TOKENS.get(s, s) for s in items)
+    block = ('\0'.join(items) + '\0').encode('utf-8')
+    binary.encode_uvarint(len(block), output)
+    output.extend(block)
+    return bytes(output)
+
+
+class PropertyCodec(object):
+
+    def __init__(self, tokenize: bool = False):
+        self.tokenize = tokenize
+
+    def encode(self, properties: dict) -> bytes:
+        items = []
+        for k, v in properties.items():
+            items.append(k)
+            items.append(property_text(v))
+        return _encode_items(tuple(items), self.tokenize)
+
+    def encode_into(self, properties: dict, buf: bytearray) -> int:
+        block = self.encode(properties)
+        buf.extend(block)
+        return len(block)
+
+    @staticmethod
+    def decode(data: Union[bytes, bytearray, memoryview]) -> dict:
+        properties = {}
+        if len(data) == 0:
+            return properties
+        data = bytes(data)
+        if data[-1] != 0:
+            raise PropertyError("property block is not NUL terminated")
+        prop_list = data[:-1].split(b'\0')
+        if len(prop_list) % 2 != 0:
+            raise PropertyError("property block has an odd number of strings")
+        for n in range(0, len(prop_list), 2):
+            k = prop_list[n]
+            v = prop_list[n + 1]
+            if len(k) == 1 and k[0] < 32:
+                k = TOKEN_VALUES.get(k[0], k)
+            key = k if type(k) is str else intern_key(k)
+            if len(v) == 1 and v[0] < 32:
+                properties[key] = TOKEN_VALUES.get(v[0], v.decode('utf-8'))
+            else:
+                properties[key] = v.decode('utf-8')
+        return properties
+
+
+codec = PropertyCodec()
+
+
+def encode_properties(properties: dict) -> bytes:
+    return codec.encode(properties)
+
+
+def decode_properties(data: Union[bytes, bytearray, memoryview]) -> dict:
+    return PropertyCodec.decode(data)
@@ -3,47 +3,105 @@
 import logging
 import asyncio
 import json
-from typing import Any
-from threading import Thread
+from typing import Any, Callable, Optional, Union
 from queue import Empty
-from .frame import BLIPMessenger, BLIPMessage, MessageType
+from concurrent.futures import Future, TimeoutError
+from .frame import BLIPMessenger, BLIPMessage, MessageType, kTypeMask, kRequestType, kErrorType, kAckRequestType, kAckResponseType
 from .exceptions import BLIPError, ClientError
 from .client import BLIPClient
+from .scheduler import FrameScheduler, FlowControl
+from .compression import CompressionPolicy
+from .reactor import Reactor
 
 logger = logging.getLogger('pythonblip.protocol')
 logger.addHandler(logging.NullHandler())
 
 
-class BLIPProtocol(BLIPClient):
+class PendingRequest(object):
+    __slots__ = ('future', 'sink', 'error')
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, future: Union[Future, asyncio.Future], sink: Callable[[memoryview], Any] = None):
+        self.future = future
+        self.sink = sink
+        self.error = None
+
+    def write(self, data: memoryview):
+        if self.error is None:
+            try:
+                self.sink(data)
+            except Exception as err:
+                self.error = err
+
+    def complete(self, m: BLIPMessage):
+        if self.future.done():
+            return
+        if m.type == kErrorType:
+            self.future.set_exception(BLIPError(m.number, m.properties, m.body_as_string()))
+        elif self.error:
+            self.future.set_exception(self.error)
+        else:
+            self.future.set_result(m)
+
+
+class AsyncBLIPProtocol(BLIPClient):
+    kTimeout = 15
+
+    def __init__(self, *args,
+                 compression: CompressionPolicy = None,
+                 frame_size: int = FrameScheduler.kFrameSize,
+                 flow: FlowControl = None,
+                 **kwargs):
         super().__init__(*args, **kwargs)
-        self.messenger = BLIPMessenger()
-        self.run_thread = Thread(target=self.start)
-        self.run_thread.start()
+        self.messenger = BLIPMessenger(compression=compression)
+        self.outbox = FrameScheduler(self.messenger, frame_size, flow, wakeup=self.notify)
+        self.pending = {}
+        self.partial = {}
+        self.connection = None
 
-    def start(self):
-        connections = [self.loop.create_task(self.connect())]
-        results = self.loop.run_until_complete(asyncio.gather(*connections, return_exceptions=True))
-        for result in results:
-            if isinstance(result, Exception):
-                logger.error(f"protocol exception: {result}")
+    async def start(self):
+        self.bind()
+        self.connection = asyncio.get_running_loop().create_task(self.run())
+        opened = asyncio.ensure_future(self.opened.wait())
+        await asyncio.wait([opened, self.connection], return_when=asyncio.FIRST_COMPLETED)
+        if not self.opened.is_set():
+            opened.cancel()
+            raise ClientError(self.run_status, self.run_message)
 
-    def stop(self):
+    async def run(self):
+        await self.connect()
+        if self.run_status == 0:
+            self.closed(503, "Connection closed")
+
+    async def stop(self):
         logger.debug(f"Received protocol stop request")
-        self.loop.create_task(self.disconnect())
-        self.run_thread.join()
+        if not self.connection:
+            return
+        if not self.connection.done():
+            await self.disconnect()
+        await self.connection
 
-    def send_message(self, m_type: int,
-                     properties: dict,
-                     body: str = "",
-                     body_json: Any = None,
-                     reply: int = None,
-                     ack_bytes: int = 0,
-                     urgent: bool = False,
-                     compress: bool = False,
-                     no_reply: bool = False,
-                     partial: bool = False):
+    def handle_exception(self, code: int, message: str):
+        self.messenger.tracer.dump()
+        self.closed(code, message)
+
+    def closed(self, code: int, message: str):
+        super().handle_exception(code, message)
+        pending = self.pending
+        self.pending = {}
+        for request in pending.values():
+            if not request.future.done():
+                request.future.set_exception(ClientError(code, message))
+
+    def build_message(self, m_type: int,
+                      properties: dict,
+                      body: str = "",
+                      body_json: Any = None,
+                      reply: int = None,
+                      ack_bytes: int = 0,
+                      urgent: bool = False,
+                      compress: Optional[bool] = None,
+                      no_reply: bool = False,
+                      partial: bool = False) -> BLIPMessage:
         m = BLIPMessage.construct()
 
         if body_json:
@@ -51,10 +109,7 @@ class BLIPProtocol(BLIPClient):
 
         if reply:
             m.set_number(reply)
-        else:
-            m.next_number()
         m.urgent = urgent
-        m.compressed = compress
         m.no_reply = no_reply
         m.more_coming = partial
         m.compute_flag(m_type)
@@ -66,47 +121,186 @@ class BLIPProtocol(BLIPClient):
         if len(body) > 0:
             m.body_import(body.encode('utf-8'))
 
-        message = self.messenger.compose(m)
-        self.write_queue.put(message)
+        if compress is None:
+            compress = self.messenger.compression.should_compress(m.body, properties)
+        m.compressed = compress
+
         return m
 
-    def receive_message(self, p: BLIPMessage = None):
-        send_ack = False
-        try:
-            data = self.read_queue.get(timeout=15)
-        except Empty:
-            raise ClientError(408, "Receive Timeout")
+    def send_message(self, m_type: int,
+                     properties: dict,
+                     body: str = "",
+                     body_json: Any = None,
+                     reply: int = None,
+                     ack_bytes: int = 0,
+                     urgent: bool = False,
+                     compress: Optional[bool] = None,
+                     no_reply: bool = False,
+                     partial: bool = False):
+        m = self.build_message(m_type, properties, body, body_json, reply, ack_bytes, urgent, compress, no_reply, partial)
+        return self.outbox.enqueue(m, assign_number=not reply)
+
+    def send_request(self, properties: dict,
+                     body: str = "",
+                     body_json: Any = None,
+                     urgent: bool = False,
+                     compress: Optional[bool] = None,
+                     sink: Callable[[memoryview], Any] = None) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        if self.run_status != 0:
+            future.set_exception(ClientError(self.run_status, self.run_message))
+            return future
+        m = self.build_message(kRequestType, properties, body, body_json, urgent=urgent, compress=compress)
+
+        def register(message: BLIPMessage):
+            self.pending[message.number] = PendingRequest(future, sink)
 
-        if data == 0:
-            raise ClientError(self.run_status.value, self.run_message.value.decode('utf-8'))
+        self.outbox.enqueue(m, assign_number=True, on_assign=register)
+        return future
 
-        if p:
-            old_received = p.frame_total
-            m: BLIPMessage = self.messenger.receive(data, continuation=True)
-            logger.debug(f"Received {m.frame_total} bytes")
-            m = p.extend(m)
+    async def request(self, properties: dict,
+                      body: str = "",
+                      body_json: Any = None,
+                      urgent: bool = False,
+                      compress: Optional[bool] = None,
+                      sink: Callable[[memoryview], Any] = None) -> BLIPMessage:
+        return await self.send_request(properties, body, body_json, urgent, compress, sink)
+
+    ## Returns whether the frame completed a peer request that went to the read queue
+    def incoming(self, data: bytes) -> bool:
+        number, flags, _ = BLIPMessenger.frame_header(data)
+        if BLIPMessenger.is_ack(flags):
+            m = self.messenger.receive(data)
+            self.outbox.acknowledge(m.number, m.type == kAckResponseType, m.ack_bytes)
+            return False
+
+        key = ((flags & kTypeMask) != kRequestType, number)
+        m = self.partial.get(key)
+        if m:
+            old_received = m.frame_total
+            m = m.extend(self.messenger.receive(data, continuation=True))
             new_received = m.frame_total
-            logger.debug(f"Received {new_received} bytes of multipart message")
-            if int(old_received / BLIPMessenger.kAckInterval) < int(new_received / BLIPMessenger.kAckInterval):
-                send_ack = True
+            logger.debug("Received %d bytes of multipart message", new_received)
+            if m.more_coming and old_received // BLIPMessenger.kAckInterval < new_received // BLIPMessenger.kAckInterval:
+                self.send_ack(m)
         else:
-            m: BLIPMessage = self.messenger.receive(data)
-
-        if m.type == 2:
-            raise BLIPError(m.number, m.properties, m.body_as_string())
+            m = self.messenger.receive(data)
+            pending = self.pending.get(number) if key[0] else None
+            if pending and pending.sink and m.type != kErrorType:
+                m.stream_to(pending.write)
 
         if m.more_coming:
-            if send_ack:
-                logger.debug(f"Sending ACK for message {m.number} bytes {m.frame_total}")
-                self.send_message(5, {}, reply=m.number, urgent=True, no_reply=True, ack_bytes=m.frame_total)
-            return self.receive_message(m)
-
-        logger.debug(f"Message #{m.number}")
-        logger.debug(f"Type: {MessageType(m.type).name}")
-        logger.debug(f"Properties: {m.properties}")
+            self.partial[key] = m
+            return False
+
+        self.partial.pop(key, None)
+        return self.deliver(m)
+
+    def send_ack(self, m: BLIPMessage):
+        logger.debug("Sending ACK for message %d bytes %d", m.number, m.frame_total)
+        if m.type == kRequestType:
+            ack_type = kAckRequestType
+        else:
+            ack_type = kAckResponseType
+        self.send_message(ack_type, {}, reply=m.number, urgent=True, no_reply=True, ack_bytes=m.frame_total)
+
+    def deliver(self, m: BLIPMessage) -> bool:
+        if m.type != kRequestType:
+            pending = self.pending.pop(m.number, None)
+            if pending:
+                if m.type == kErrorType:
+                    self.messenger.tracer.dump()
+                pending.complete(m)
+                return False
+        self.read_queue.push(m)
+        return True
+
+    def next_frame(self):
+        frame = self.outbox.next_frame()
+        if frame is None:
+            raise Empty
+        return frame
+
+    async def response(self, future: asyncio.Future, timeout: float = kTimeout) -> BLIPMessage:
         try:
-            logger.debug(f"Body: {m.body_as_string()}")
-        except UnicodeDecodeError:
-            logger.debug("Body: .... [binary data]")
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            raise ClientError(408, "Receive Timeout")
+
+    async def receive_message(self, timeout: float = kTimeout) -> BLIPMessage:
+        try:
+            m = await self.read_queue.get_async(timeout)
+        except Empty:
+            raise ClientError(408, "Receive Timeout")
+        return self.accept(m)
+
+    def accept(self, m: Any) -> BLIPMessage:
+        if not isinstance(m, BLIPMessage):
+            raise ClientError(self.run_status, self.run_message)
+
+        if m.type == kErrorType:
+            self.messenger.tracer.dump()
+            raise BLIPError(m.number, m.properties, m.body_as_string())
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Message #%d", m.number)
+            logger.debug("Type: %s", MessageType(m.type).name)
+            logger.debug("Properties: %s", m.properties)
+            try:
+                logger.debug("Body: %s", m.body_as_string())
+            except UnicodeDecodeError:
+                logger.debug("Body: .... [binary data]")
 
         return m
+
+
+## Blocking facade that runs an AsyncBLIPProtocol on a reactor thread
+class BLIPProtocol(object):
+    kTimeout = AsyncBLIPProtocol.kTimeout
+
+    def __init__(self, *args, reactor: Reactor = None, shared: bool = False, **kwargs):
+        if not reactor and shared:
+            reactor = Reactor.shared()
+        self.own_reactor = reactor is None
+        self.reactor = reactor if reactor else Reactor()
+        self.protocol = AsyncBLIPProtocol(*args, **kwargs)
+        self.started = self.reactor.submit(self.protocol.start())
+
+    @property
+    def messenger(self) -> BLIPMessenger:
+        return self.protocol.messenger
+
+    @property
+    def outbox(self) -> FrameScheduler:
+        return self.protocol.outbox
+
+    def stop(self):
+        try:
+            self.reactor.run_sync(self.protocol.stop())
+        finally:
+            if self.own_reactor:
+                self.reactor.stop()
+
+    def send_message(self, *args, **kwargs):
+        return self.protocol.send_message(*args, **kwargs)
+
+    def send_request(self, properties: dict,
+                     body: str = "",
+                     body_json: Any = None,
+                     urgent: bool = False,
+                     compress: Optional[bool] = None,
+                     sink: Callable[[memoryview], Any] = None) -> Future:
+        return self.reactor.submit(self.protocol.request(properties, body, body_json, urgent, compress, sink))
+
+    def response(self, future: Future, timeout: float = kTimeout) -> BLIPMessage:
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            raise ClientError(408, "Receive Timeout")
+
+    def receive_message(self, timeout: float = kTimeout) -> BLIPMessage:
+        try:
+            m = self.protocol.read_queue.get(timeout=timeout)
+        except Empty:
+            raise ClientError(408, "Receive Timeout")
+        return self.protocol.accept(m)
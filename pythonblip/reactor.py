@@ -0,0 +1,72 @@
+##
+##
+
+import asyncio
+import logging
+import threading
+import itertools
+from concurrent.futures import Future
+from typing import Any, Awaitable
+
+logger = logging.getLogger('pythonblip.reactor')
+logger.addHandler(logging.NullHandler())
+
+
+class Reactor(object):
+    kPoolSize = 1
+    _pool = []
+    _pool_next = itertools.count()
+    _pool_lock = threading.Lock()
+
+    def __init__(self, name: str = "pythonblip-reactor"):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        logger.debug(f"reactor {self.thread.name} started")
+        try:
+            self.loop.run_forever()
+        finally:
+            logger.debug(f"reactor {self.thread.name} stopped")
+
+    @property
+    def running(self) -> bool:
+        return self.thread.is_alive()
+
+    def submit(self, coro: Awaitable) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run_sync(self, coro: Awaitable, timeout: float = None) -> Any:
+        if threading.current_thread() is self.thread:
+            raise RuntimeError("run_sync() called from the reactor thread")
+        return self.submit(coro).result(timeout)
+
+    ## Process-wide reactors shared by every wrapper that opts in; connections are spread round-robin
+    @classmethod
+    def shared(cls, size: int = None) -> 'Reactor':
+        with cls._pool_lock:
+            if not cls._pool:
+                size = size if size else cls.kPoolSize
+                cls._pool = [cls(f"pythonblip-shared-{n}") for n in range(size)]
+            return cls._pool[next(cls._pool_next) % len(cls._pool)]
+
+    @classmethod
+    def shutdown_shared(cls):
+        with cls._pool_lock:
+            pool = cls._pool
+            cls._pool = []
+        for reactor in pool:
+            reactor.stop()
+
+    def call(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self):
+        if not self.running:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if threading.current_thread() is not self.thread:
+            self.thread.join()
+            self.loop.close()
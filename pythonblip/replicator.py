@@ -2,23 +2,40 @@
 
 import attr
 import time
+import asyncio
 import logging
 from hashlib import sha1, sha256
 import base64
 import uuid
 import json
-from attr.validators import instance_of
+from collections import deque
+from attr.validators import instance_of, optional
 from enum import Enum
-from typing import Union
+from typing import Optional, Union, Deque
 from .headers import SessionAuth, BasicAuth
 from .exceptions import ReplicationError, BLIPError, ClientError
-from .protocol import BLIPProtocol
-from .output import LocalDB, LocalFile, ScreenOutput
+from .protocol import AsyncBLIPProtocol
+from .frame import BLIPMessage
+from .reactor import Reactor
+from .pool import ConnectionPool
+from .compression import CompressionPolicy
+from .retry import RetryPolicy
+from .transport import TransportConfig
+from .output import LocalDB, LocalFile, ScreenOutput, AttachmentWriter
 
 logger = logging.getLogger('pythonblip.replicator')
 logger.addHandler(logging.NullHandler())
 
 
+def sequence_key(sequence: Union[int, str]) -> int:
+    if isinstance(sequence, int):
+        return sequence
+    try:
+        return int(str(sequence).split(':')[-1])
+    except ValueError:
+        return 0
+
+
 class ReplicatorType(Enum):
     PULL = 1
     PUSH = 2
@@ -38,6 +55,11 @@ class ReplicatorConfiguration(object):
     datastore = attr.ib(validator=instance_of((LocalDB, LocalFile, ScreenOutput)))
     continuous = attr.ib(validator=instance_of(bool))
     checkpoint = attr.ib(validator=instance_of(bool))
+    compression = attr.ib(default=None, validator=optional(instance_of(CompressionPolicy)))
+    retry = attr.ib(default=attr.Factory(RetryPolicy), validator=instance_of(RetryPolicy))
+    transport = attr.ib(default=None, validator=optional(instance_of(TransportConfig)))
+    checkpoint_interval = attr.ib(default=10.0, validator=instance_of((int, float)))
+    concurrency = attr.ib(default=4, validator=instance_of(int))
 
     @classmethod
     def create(cls, database: str,
@@ -50,7 +72,12 @@ class ReplicatorConfiguration(object):
                collections: list[str] = None,
                output: Union[LocalDB, LocalFile, ScreenOutput] = None,
                continuous: bool = False,
-               checkpoint: bool = True):
+               checkpoint: bool = True,
+               compression: CompressionPolicy = None,
+               retry: RetryPolicy = None,
+               transport: TransportConfig = None,
+               checkpoint_interval: float = 10.0,
+               concurrency: int = 4):
         if not collections:
             collections = ["_default"]
         if tls:
@@ -68,14 +95,115 @@ class ReplicatorConfiguration(object):
             collections,
             output.database(database, collections),
             continuous,
-            checkpoint
+            checkpoint,
+            compression,
+            retry if retry else RetryPolicy(),
+            transport,
+            checkpoint_interval,
+            concurrency
         )
 
 
-class Replicator(object):
+## Pipeline state for one collection's changes feed: batches waiting for revisions or attachments, in arrival order
+class ChangesFeed(object):
+
+    def __init__(self, number: int, collection: str, inbox: asyncio.Queue = None):
+        self.number = number
+        self.collection = collection
+        self.inbox = inbox
+        self.pending: Deque[ChangesBatch] = deque()
+        self.outstanding = {}
+        self.fetch = None
+        self.caught_up = False
+
+    @property
+    def fetching(self) -> bool:
+        return any(batch.fetch and not batch.fetch.done() for batch in self.pending)
+
+    @property
+    def changes(self) -> list:
+        return [change for batch in self.pending for change in batch.changes]
+
+
+## Hands each request arriving on a shared connection to the inbox of the collection it names; a connection
+## failure is passed to every inbox so each collection sees it. A full inbox holds up the router, which leaves
+## requests in the protocol's read queue and, once that fills, pauses socket reads. Collection loops only wait on
+## their inbox or on responses, which the protocol completes without the router, so one slow collection cannot
+## block another for good
+class CollectionRouter(object):
+    kInboxSize = 256
+
+    def __init__(self, blip: AsyncBLIPProtocol):
+        self.blip = blip
+        self.inboxes = {}
+
+    def inbox(self, number: int) -> asyncio.Queue:
+        return self.inboxes.setdefault(number, asyncio.Queue(self.kInboxSize))
+
+    ## A collection that is done no longer drains its inbox, so what is left in it is answered and dropped
+    def close(self, number: int):
+        inbox = self.inboxes.pop(number, None)
+        if inbox:
+            self.drain(inbox)
+
+    def drain(self, inbox: asyncio.Queue):
+        while not inbox.empty():
+            m = inbox.get_nowait()
+            if isinstance(m, BLIPMessage):
+                self.discard(m)
+
+    def discard(self, m: BLIPMessage):
+        if not m.no_reply:
+            logger.debug(f"No collection for message #{m.number} properties {m.properties}")
+            self.blip.send_message(1, {}, reply=m.number, body_json=[])
 
-    def __init__(self, config: ReplicatorConfiguration):
+    async def run(self):
+        while True:
+            try:
+                m = await self.blip.receive_message(None)
+            except (BLIPError, ClientError) as err:
+                for inbox in list(self.inboxes.values()):
+                    await inbox.put(err)
+                return
+            number = int(m.properties.get("collection", 0))
+            inbox = self.inboxes.get(number)
+            if not inbox:
+                self.discard(m)
+                continue
+            await inbox.put(m)
+            if self.inboxes.get(number) is not inbox:
+                self.drain(inbox)
+
+
+class ChangesBatch(object):
+    __slots__ = ('changes', 'sequence', 'remaining', 'attachments', 'fetch')
+
+    def __init__(self, changes: list):
+        self.changes = changes
+        self.sequence = max((change[0] for change in changes), key=sequence_key)
+        self.remaining = set()
+        self.attachments = []
+        self.fetch: Optional[asyncio.Task] = None
+
+    @property
+    def fetched(self) -> bool:
+        return self.fetch is None or (self.fetch.done() and not self.fetch.cancelled() and self.fetch.exception() is None)
+
+    @property
+    def failed(self) -> bool:
+        return self.fetch is not None and self.fetch.done() and not self.fetch.cancelled() and self.fetch.exception() is not None
+
+    @property
+    def complete(self) -> bool:
+        return not self.remaining and self.fetched
+
+
+class AsyncReplicator(object):
+    kAttachmentWindow = 8
+
+    def __init__(self, config: ReplicatorConfiguration, pool: ConnectionPool = None):
         self.config = config
+        self.pool = pool
         self.uuid = str(uuid.getnode())
         self.client = self.get_id_hash()
         self.get_checkpoint_props = {
@@ -88,6 +216,7 @@ class Replicator(object):
             "checkpoint_ids": [],
             "collections": []
         }
+        ## The property dicts are templates; collections run concurrently, so each request is sent with its own copy
         self.set_checkpoint_props = {
             "Profile": "setCheckpoint",
             "client": self.client,
@@ -109,6 +238,9 @@ class Replicator(object):
             "versioning": "rev-trees",
             "activeOnly": True
         }
+        if self.config.continuous:
+            self.sub_changes_props["continuous"] = True
+            self.sub_changes_collection_props["continuous"] = True
         self.max_history_props = {
             "maxHistory": 20,
             "blobs": True,
@@ -120,7 +252,14 @@ class Replicator(object):
             "docID": ""
         }
         self.history_body = []
-        self.attachments = []
+        self.attachments = {}
+        self.progress = {}
+        self.changes = {}
+        self.stored = {}
+        self.checkpointed = {}
+        self.saving = {}
+        self.task = None
+        self.stopping = False
         self.collections = self.config.collections
         self.collection_list = []
         self.hash_list = []
@@ -131,7 +270,7 @@ class Replicator(object):
                 _hash = self.get_id_hash(self.config.scope, collection)
                 self.collection_list.append(_target)
                 self.hash_list.append(_hash)
-        self.blip = BLIPProtocol(self.config.target, self.config.authenticator.header(), self.config.tls)
+        self.blip = None if self.pool else self.new_protocol()
         logger.info(f"Replicator active for client {self.client}")
 
     def get_id_hash(self, scope: str = None, collection: str = None) -> str:
@@ -153,7 +292,24 @@ class Replicator(object):
         checkpoint = base64.b64encode(bytes.fromhex(r_uuid)).decode()
         return f"cp-{checkpoint}"
 
-    def start(self):
+    def new_protocol(self) -> AsyncBLIPProtocol:
+        return AsyncBLIPProtocol(self.config.target,
+                                 self.config.authenticator.header(),
+                                 self.config.tls,
+                                 compression=self.config.compression,
+                                 transport=self.config.transport)
+
+    async def connect(self):
+        if self.pool:
+            self.blip = await self.pool.acquire(self.config.target,
+                                                self.config.authenticator.header(),
+                                                self.config.tls,
+                                                compression=self.config.compression,
+                                                transport=self.config.transport)
+        else:
+            await self.blip.start()
+
+    async def start(self):
         message_body = None
         if len(self.collection_list) > 0:
             self.get_checkpoint_props.update({"Profile": "getCollections"})
@@ -163,16 +319,19 @@ class Replicator(object):
         else:
             self.get_checkpoint_props.update({"client": self.client})
         try:
-            self.blip.send_message(0, self.get_checkpoint_props, body_json=message_body)
-            checkpoint_message = self.blip.receive_message()
-            checkpoint = json.loads(checkpoint_message.body.decode('utf-8'))
+            await self.connect()
+            request = self.blip.send_request(self.get_checkpoint_props, body_json=message_body)
+            checkpoint_message = await self.blip.response(request)
+            checkpoint = json.loads(checkpoint_message.body_as_string())
             if type(checkpoint) == dict:
                 self.set_checkpoint_body.update({"time": checkpoint['time']})
                 self.set_checkpoint_body.update({"remote": checkpoint['remote']})
                 self.set_checkpoint_props.update({"rev": checkpoint_message.properties.get("rev", "")})
+                self.seed_progress([checkpoint])
             else:
                 self.collection_rev_list = checkpoint
                 logger.debug(self.collection_rev_list)
+                self.seed_progress(checkpoint)
         except BLIPError as err:
             if err.error_code:
                 if err.error_code == 404:
@@ -187,14 +346,23 @@ class Replicator(object):
         except Exception as err:
             raise ReplicationError(f"General error: {err}")
 
-    def get_collections(self):
+    ## Each collection's saved remote sequence becomes its starting point unless this session already moved past it
+    def seed_progress(self, checkpoints: list):
+        for collection, checkpoint in zip(self.collections, checkpoints):
+            if not checkpoint or not checkpoint.get("remote") or collection in self.progress:
+                continue
+            self.progress[collection] = checkpoint["remote"]
+            self.checkpointed[collection] = checkpoint["remote"]
+
+    async def get_collections(self):
         try:
             self.checkpoint_collections_body.update({"checkpoint_ids": self.hash_list})
             self.checkpoint_collections_body.update({"collections": self.collection_list})
-            self.blip.send_message(0, self.get_checkpoint_collections_props, body_json=self.checkpoint_collections_body)
-            checkpoint_message = self.blip.receive_message()
-            checkpoint = json.loads(checkpoint_message.body.decode('utf-8'))
+            request = self.blip.send_request(self.get_checkpoint_collections_props, body_json=self.checkpoint_collections_body)
+            checkpoint_message = await self.blip.response(request)
+            checkpoint = json.loads(checkpoint_message.body_as_string())
             self.set_checkpoint_body_list = checkpoint
+            self.seed_progress(checkpoint)
         except BLIPError as err:
             if err.error_code:
                 if err.error_code == 404:
@@ -209,88 +377,444 @@ class Replicator(object):
         except Exception as err:
             raise ReplicationError(f"General error: {err}")
 
-    def replicate(self):
-        for n, collection in enumerate(self.collections):
-            history_body = []
-            sequences = []
-            attachments = []
+    ## A continuous replication runs until stop(), which cancels it once the last checkpoint is saved
+    async def replicate(self):
+        self.task = asyncio.current_task()
+        try:
+            await self.replicate_with_retry(list(enumerate(self.collections)))
+        except asyncio.CancelledError:
+            if not self.stopping:
+                raise
+        finally:
+            self.task = None
+
+    ## A failure interrupts every collection sharing the connection; finished collections are dropped from
+    ## `remaining`, so a retry resumes only the others, each from its own progress
+    async def replicate_with_retry(self, remaining: list):
+        attempt = 0
+        while remaining:
+            unfinished = len(remaining)
             try:
-                logger.info(f"Replicating collection {collection}")
-                if collection != "_default":
-                    self.sub_changes_props["collection"] = n
-                sub_changes_message = self.blip.send_message(0, self.sub_changes_props)
-                reply_message = self.blip.receive_message()
-                doc_list = self.blip.receive_message()
-                doc_count = json.loads(doc_list.body_as_string())
-                if not doc_count:
-                    continue
-                for i in range(len(doc_count)):
-                    history_body.append([])
-                max_history_msg = self.blip.send_message(1, self.max_history_props, reply=doc_list.number, body_json=history_body)
-                changes_reply_msg = self.blip.receive_message()
-                received_doc_count = 0
-                for _ in range(len(doc_count)):
-                    reply_message = self.blip.receive_message()
-                    sequences.append(reply_message.properties['sequence'])
-                    doc_id = reply_message.properties['id']
-                    document = reply_message.body.decode('utf-8')
-                    try:
-                        document = json.loads(document)
-                        if document.get("_attachments"):
-                            attachment = {"docID": doc_id}
-                            for item in document.get("_attachments"):
-                                attachment.update(document.get("_attachments", {}).get(item))
-                            attachments.append(attachment)
-                    except json.decoder.JSONDecodeError:
-                        pass
-                    self.config.datastore.write(doc_id, document, collection=collection)
-                    received_doc_count += 1
-                logger.info(f"Replicated {received_doc_count} documents")
-                logger.debug(f"Max sequence {max(sequences)}")
-                if self.config.checkpoint:
-                    logger.info(f"Setting checkpoint for sequence {max(sequences)}")
-                    self.set_checkpoint_body.update({"remote": max(sequences)})
-                    if collection != "_default":
-                        self.set_checkpoint_props["collection"] = n
-                        self.set_checkpoint_props["client"] = self.checkpoint_collections_body["checkpoint_ids"][n]
-                        self.set_checkpoint_props["rev"] = self.collection_rev_list[n].get("_rev", "")
-                    set_checkpoint = self.blip.send_message(0, self.set_checkpoint_props, body_json=self.set_checkpoint_body)
-                    reply_message = self.blip.receive_message()
-                    self.set_checkpoint_props.update({"rev": reply_message.properties.get("rev", "")})
-                for attachment in attachments:
-                    self.get_attachment(attachment, n, collection)
+                if attempt > 0:
+                    await self.reconnect(attempt - 1)
+                if len(remaining) > 1 and (self.config.concurrency > 1 or self.config.continuous):
+                    await self.replicate_concurrently(remaining)
+                else:
+                    for n, collection in list(remaining):
+                        await self.replicate_collection(n, collection)
+                        remaining.remove((n, collection))
             except BLIPError as err:
-                self.stop()
+                await self.abort()
                 raise ReplicationError(f"Replication protocol error: {err}")
             except ClientError as err:
+                if self.stopping:
+                    return
                 if err.error_code == 401:
                     raise ReplicationError("Unauthorized: invalid credentials provided.")
-                else:
-                    self.stop()
+                for n, collection in remaining:
+                    self.save_progress(collection)
+                if len(remaining) < unfinished:
+                    attempt = 0
+                if not self.config.retry.retryable(err, attempt):
+                    await self.abort()
                     raise ReplicationError(f"Websocket error: {err}")
+                logger.warning(f"Replication of {', '.join(collection for n, collection in remaining)} interrupted: {err}")
+                attempt += 1
             except Exception as err:
-                self.stop()
+                await self.abort()
                 raise ReplicationError(f"General error: {err}")
 
-    def get_attachment(self, attachment: dict, number: int, collection: str):
-        data = bytearray()
+    ## Up to `concurrency` collections pull at once over the one connection (a continuous replication runs them
+    ## all); the router hands each incoming request to its collection's inbox
+    async def replicate_concurrently(self, remaining: list):
+        loop = asyncio.get_running_loop()
+        router = CollectionRouter(self.blip)
+        limit = asyncio.Semaphore(len(remaining) if self.config.continuous else self.config.concurrency)
+        tasks = [loop.create_task(self.replicate_routed(n, collection, router, limit, remaining))
+                 for n, collection in remaining]
+        dispatcher = loop.create_task(router.run())
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.wait(tasks)
+            dispatcher.cancel()
+            await asyncio.wait([dispatcher])
+        errors = [task.exception() for task in tasks if not task.cancelled() and task.exception()]
+        if errors:
+            raise errors[0]
+
+    async def replicate_routed(self, n: int, collection: str, router: CollectionRouter, limit: asyncio.Semaphore, remaining: list):
+        inbox = router.inbox(n)
+        try:
+            async with limit:
+                await self.replicate_collection(n, collection, inbox)
+        finally:
+            router.close(n)
+        remaining.remove((n, collection))
+
+    async def reconnect(self, attempt: int):
+        delay = self.config.retry.delay(attempt)
+        logger.info(f"Reconnecting in {delay:.2f} seconds (attempt {attempt + 1} of {self.config.retry.max_attempts})")
+        await self.abort()
+        self.saving.clear()
+        await asyncio.sleep(delay)
+        if not self.pool:
+            self.blip = self.new_protocol()
+        await self.connect()
+        if self.collection_list:
+            await self.register_collections()
+
+    ## The server keeps the collection list per connection, so a new connection has to send getCollections again
+    async def register_collections(self):
+        request = self.blip.send_request(self.get_checkpoint_collections_props, body_json=self.checkpoint_collections_body)
+        checkpoint_message = await self.blip.response(request)
+        self.collection_rev_list = json.loads(checkpoint_message.body_as_string())
+        self.seed_progress(self.collection_rev_list)
+
+    ## Each changes batch is answered as soon as it arrives and revisions are matched back to their batch, so the
+    ## server can keep streaming; memory is bounded by the batches in flight, not by the size of the collection
+    async def replicate_collection(self, n: int, collection: str, inbox: asyncio.Queue = None):
+        attachments = self.attachments.setdefault(collection, [])
+        feed = ChangesFeed(n, collection, inbox)
+
+        logger.info(f"Replicating collection {collection}")
+        await self.get_attachments(attachments, n, collection)
+        sub_changes_props = dict(self.sub_changes_props)
+        if collection != "_default":
+            sub_changes_props["collection"] = n
+        if collection in self.progress:
+            sub_changes_props["since"] = self.progress[collection]
+            logger.info(f"Pulling {collection} changes since sequence {self.progress[collection]}")
+        sub_changes = self.blip.send_request(sub_changes_props)
+        await self.blip.response(sub_changes)
+        last_checkpoint = time.monotonic()
+        try:
+            while True:
+                self.advance(feed)
+                self.check(feed)
+                if feed.caught_up and not feed.outstanding and not self.config.continuous:
+                    break
+                if time.monotonic() - last_checkpoint >= self.config.checkpoint_interval:
+                    self.save_checkpoint(n, collection)
+                    last_checkpoint = time.monotonic()
+                m = await self.next_message(feed)
+                if m is None:
+                    continue
+                profile = m.properties.get('Profile')
+                if profile == 'changes':
+                    self.answer_changes(feed, m)
+                    if feed.caught_up and self.config.continuous:
+                        logger.info(f"Collection {collection} is up to date")
+                        self.save_checkpoint(n, collection)
+                        last_checkpoint = time.monotonic()
+                elif profile == 'rev':
+                    self.store_revision(feed, m)
+                else:
+                    if not m.no_reply:
+                        self.blip.send_message(1, {}, reply=m.number, body_json=[])
+                    if profile == 'norev':
+                        self.settle(feed, (m.properties.get('id'), m.properties.get('rev')))
+            fetches = [batch.fetch for batch in feed.pending if batch.fetch]
+            if fetches:
+                await asyncio.wait(fetches)
+            self.advance(feed)
+            self.check(feed)
+        except (Exception, asyncio.CancelledError) as err:
+            self.advance(feed)
+            await self.interrupted(feed, attachments)
+            if isinstance(err, asyncio.CancelledError) and self.stopping:
+                await self.checkpoint(n, collection, final=True)
+            raise
+        self.changes.pop(collection, None)
+        await self.get_attachments(attachments, n, collection)
+        await self.checkpoint(n, collection)
+
+    ## While live, an idle wait gives up after the checkpoint interval so a pending checkpoint is not held back
+    async def next_message(self, feed: ChangesFeed) -> Optional[BLIPMessage]:
+        if not self.config.continuous:
+            return await self.receive(feed)
+        if self.checkpoint_due(feed.collection) or feed.fetching:
+            timeout = self.config.checkpoint_interval
+        else:
+            timeout = None
+        try:
+            return await self.receive(feed, timeout)
+        except ClientError as err:
+            if err.error_code != 408:
+                raise
+            return None
+
+    async def receive(self, feed: ChangesFeed, timeout: Optional[float] = AsyncBLIPProtocol.kTimeout) -> BLIPMessage:
+        if feed.inbox is None:
+            return await self.blip.receive_message(timeout)
+        try:
+            m = await asyncio.wait_for(feed.inbox.get(), timeout)
+        except asyncio.TimeoutError:
+            raise ClientError(408, "Receive Timeout")
+        if isinstance(m, Exception):
+            raise m
+        return m
+
+    def answer_changes(self, feed: ChangesFeed, m: BLIPMessage):
+        changes = json.loads(m.body_as_string())
+        feed.caught_up = not changes
+        if not changes:
+            if not m.no_reply:
+                self.blip.send_message(1, {}, reply=m.number, body_json=[])
+            return
+        stored = self.stored.setdefault(feed.collection, set())
+        batch = ChangesBatch(changes)
+        history_body = []
+        for change in changes:
+            key = (change[1], change[2])
+            if key in stored or key in feed.outstanding:
+                history_body.append(0)
+            else:
+                history_body.append([])
+                batch.remaining.add(key)
+                feed.outstanding[key] = batch
+        self.blip.send_message(1, self.max_history_props, reply=m.number, body_json=history_body)
+        feed.pending.append(batch)
+        logger.debug(f"Collection {feed.collection}: {len(changes)} changes, {len(batch.remaining)} wanted")
+
+    def store_revision(self, feed: ChangesFeed, m: BLIPMessage):
+        doc_id = m.properties['id']
+        key = (doc_id, m.properties.get('rev'))
+        batch = feed.outstanding.get(key)
+        document = m.body_as_string()
+        try:
+            document = json.loads(document)
+            if document.get("_attachments"):
+                attachment = {"docID": doc_id}
+                for item in document.get("_attachments"):
+                    attachment.update(document.get("_attachments", {}).get(item))
+                if batch:
+                    batch.attachments.append(attachment)
+                else:
+                    self.attachments[feed.collection].append(attachment)
+        except json.decoder.JSONDecodeError:
+            pass
+        self.config.datastore.write(doc_id, document, collection=feed.collection)
+        self.settle(feed, key)
+
+    ## A batch whose revisions are all in starts fetching its attachments behind the previous batch's fetch
+    def settle(self, feed: ChangesFeed, key: tuple):
+        batch = feed.outstanding.pop(key, None)
+        if not batch:
+            return
+        self.stored.setdefault(feed.collection, set()).add(key)
+        batch.remaining.discard(key)
+        if batch.remaining or not batch.attachments:
+            return
+        batch.fetch = asyncio.get_running_loop().create_task(self.fetch_attachments(batch, feed.fetch, feed.number, feed.collection))
+        feed.fetch = batch.fetch
+
+    async def fetch_attachments(self, batch: ChangesBatch, previous: Optional[asyncio.Task], number: int, collection: str):
+        if previous:
+            await asyncio.wait([previous])
+        await self.get_attachments(batch.attachments, number, collection)
+
+    ## Progress moves in batch order, so a checkpoint never passes a change that is not stored with its attachments
+    def advance(self, feed: ChangesFeed):
+        stored = self.stored.setdefault(feed.collection, set())
+        while feed.pending and feed.pending[0].complete:
+            batch = feed.pending.popleft()
+            for change in batch.changes:
+                stored.discard((change[1], change[2]))
+            self.progress[feed.collection] = batch.sequence
+            logger.info(f"Replicated {len(batch.changes)} changes through sequence {batch.sequence}")
+
+    @staticmethod
+    def check(feed: ChangesFeed):
+        for batch in feed.pending:
+            if batch.failed:
+                raise batch.fetch.exception()
+
+    ## Leaves what a retry needs: the unfinished changes for save_progress() and the attachments still to fetch
+    async def interrupted(self, feed: ChangesFeed, attachments: list):
+        fetches = [batch.fetch for batch in feed.pending if batch.fetch]
+        for fetch in fetches:
+            fetch.cancel()
+        if fetches:
+            await asyncio.wait(fetches)
+        self.changes[feed.collection] = feed.changes
+        for batch in feed.pending:
+            attachments.extend(batch.attachments)
+
+    def checkpoint_due(self, collection: str) -> bool:
+        return self.config.checkpoint and collection in self.progress and self.checkpointed.get(collection) != self.progress[collection]
+
+    ## Waits for the collection's checkpoint to be saved, at the end of a pull or on stop; on stop the connection may
+    ## already be failing, so errors are only logged
+    async def checkpoint(self, n: int, collection: str, final: bool = False):
+        try:
+            await self.checkpoint_reply(collection)
+            self.save_checkpoint(n, collection)
+            await self.checkpoint_reply(collection)
+        except (BLIPError, ClientError) as err:
+            if not final:
+                raise
+            logger.warning(f"Final checkpoint for {collection} not saved: {err}")
+
+    ## A save interrupted by stop() stays in `saving`, so the final checkpoint waits for it and sends with its revision
+    async def checkpoint_reply(self, collection: str):
+        in_flight = self.saving.get(collection)
+        if not in_flight:
+            return
+        try:
+            await self.blip.response(in_flight)
+        except (BLIPError, ClientError):
+            self.saving.pop(collection, None)
+            raise
+
+    ## Sends setCheckpoint if progress moved and no save is in flight, without waiting: the reply is recorded by a
+    ## callback, while the receive loop keeps draining the revisions the server streams ahead of it. A failed earlier
+    ## save is raised here
+    def save_checkpoint(self, n: int, collection: str):
+        in_flight = self.saving.get(collection)
+        if in_flight:
+            if not in_flight.done():
+                return
+            del self.saving[collection]
+            if not in_flight.cancelled() and in_flight.exception():
+                raise in_flight.exception()
+        if not self.checkpoint_due(collection):
+            return
+        sequence = self.progress[collection]
+        logger.info(f"Setting checkpoint for sequence {sequence}")
+        set_checkpoint_props = dict(self.set_checkpoint_props)
+        set_checkpoint_body = dict(self.set_checkpoint_body, remote=sequence)
+        if collection != "_default":
+            set_checkpoint_props["collection"] = n
+            set_checkpoint_props["client"] = self.checkpoint_collections_body["checkpoint_ids"][n]
+            set_checkpoint_props["rev"] = self.collection_rev_list[n].get("_rev", "")
+        set_checkpoint = self.blip.send_request(set_checkpoint_props, body_json=set_checkpoint_body)
+        set_checkpoint.add_done_callback(lambda future: self.checkpoint_saved(future, n, collection, sequence))
+        self.saving[collection] = set_checkpoint
+
+    def checkpoint_saved(self, future: asyncio.Future, n: int, collection: str, sequence: Union[int, str]):
+        if future.cancelled() or future.exception():
+            return
+        rev = future.result().properties.get("rev", "")
+        if collection != "_default":
+            self.collection_rev_list[n]["_rev"] = rev
+        else:
+            self.set_checkpoint_props.update({"rev": rev})
+        self.checkpointed[collection] = sequence
+
+    ## Resume point after a failure: the highest sequence below which every requested change was stored
+    def save_progress(self, collection: str):
+        stored = self.stored.get(collection, set())
+        changes = sorted(self.changes.get(collection, []), key=lambda change: sequence_key(change[0]))
+        for change in changes:
+            if (change[1], change[2]) not in stored:
+                break
+            self.progress[collection] = change[0]
+
+    def request_attachment(self, attachment: dict, number: int, collection: str):
         logger.info(f"Getting attachment for {attachment['docID']} length {attachment['length']} collection {collection} #{number}")
-        self.get_attachment_props["digest"] = attachment["digest"]
-        self.get_attachment_props["docID"] = attachment["docID"]
+        get_attachment_props = dict(self.get_attachment_props, digest=attachment["digest"], docID=attachment["docID"])
         if collection != "_default":
-            self.get_attachment_props["collection"] = number
+            get_attachment_props["collection"] = number
+        writer = self.config.datastore.open_attachment(attachment['docID'],
+                                                       attachment['content_type'],
+                                                       attachment.get('length', 0),
+                                                       collection=collection)
+        try:
+            request = self.blip.send_request(get_attachment_props, sink=writer.write)
+        except Exception:
+            writer.abort()
+            raise
+        return writer, request
+
+    async def complete_attachment(self, writer: AttachmentWriter, request: asyncio.Future):
+        try:
+            await self.blip.response(request)
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
+        logger.debug(f"Received {writer.size} bytes")
+
+    ## Completed attachments are removed from the list so a retry only fetches the remainder
+    async def get_attachments(self, attachments: list[dict], number: int, collection: str):
+        while attachments:
+            window = attachments[:self.kAttachmentWindow]
+            requests = []
+            try:
+                for attachment in window:
+                    requests.append(self.request_attachment(attachment, number, collection))
+                for attachment in window:
+                    writer, request = requests.pop(0)
+                    await self.complete_attachment(writer, request)
+                    attachments.remove(attachment)
+            except Exception:
+                for writer, request in requests:
+                    writer.abort()
+                raise
+
+    async def get_attachment(self, attachment: dict, number: int, collection: str):
         try:
-            self.blip.send_message(0, self.get_attachment_props)
-            reply_message = self.blip.receive_message()
-            data = reply_message.body_as_bytes()
-            self.config.datastore.write_attachment(attachment['docID'], attachment['content_type'], data, collection=collection)
+            await self.get_attachments([attachment], number, collection)
         except Exception as err:
-            import traceback
-            tb = traceback.format_exc()
-            print(tb)
-            self.stop()
+            await self.abort()
             raise ReplicationError(f"Get attachment error: {err}")
-        logger.debug(f"Received {len(data)} bytes")
+
+    async def stop(self):
+        self.stopping = True
+        if self.task and self.task is not asyncio.current_task():
+            self.task.cancel()
+            await asyncio.wait([self.task])
+        await self.release()
+
+    async def abort(self):
+        await self.release(discard=True)
+
+    ## A connection that carried a live subscription is never handed back to the pool
+    async def release(self, discard: bool = False):
+        if not self.blip:
+            return
+        if self.pool:
+            await self.pool.release(self.blip, discard=discard or self.config.continuous)
+        else:
+            await self.blip.stop()
+
+
+## Blocking facade that drives an AsyncReplicator on a reactor thread
+class Replicator(object):
+
+    def __init__(self,
+                 config: ReplicatorConfiguration,
+                 reactor: Reactor = None,
+                 shared: bool = False,
+                 pool: ConnectionPool = None):
+        self.config = config
+        if pool:
+            reactor = pool.reactor
+        elif not reactor and shared:
+            reactor = Reactor.shared()
+        self.own_reactor = reactor is None
+        self.reactor = reactor if reactor else Reactor()
+        self.replicator = AsyncReplicator(config, pool)
+
+    @property
+    def blip(self) -> AsyncBLIPProtocol:
+        return self.replicator.blip
+
+    def start(self):
+        self.reactor.run_sync(self.replicator.start())
+
+    def get_collections(self):
+        self.reactor.run_sync(self.replicator.get_collections())
+
+    def replicate(self):
+        self.reactor.run_sync(self.replicator.replicate())
 
     def stop(self):
-        self.blip.stop()
+        try:
+            self.reactor.run_sync(self.replicator.stop())
+        finally:
+            if self.own_reactor:
+                self.reactor.stop()
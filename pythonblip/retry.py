@@ -0,0 +1,44 @@
+##
+##
+
+import random
+import logging
+from .exceptions import ClientError
+
+logger = logging.getLogger('pythonblip.retry')
+logger.addHandler(logging.NullHandler())
+
+
+class RetryPolicy(object):
+    kMaxAttempts = 8
+    kBaseDelay = 0.5
+    kMaxDelay = 30.0
+    kFatalCodes = (400, 401, 403, 404)
+
+    def __init__(self,
+                 max_attempts: int = kMaxAttempts,
+                 base_delay: float = kBaseDelay,
+                 max_delay: float = kMaxDelay,
+                 jitter: bool = True):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    @classmethod
+    def disabled(cls):
+        return cls(max_attempts=0)
+
+    ## Full jitter: a uniform delay up to the exponential ceiling spreads out clients that dropped together
+    def delay(self, attempt: int) -> float:
+        ceiling = min(self.max_delay, self.base_delay * (2 ** attempt))
+        if self.jitter:
+            return random.uniform(0, ceiling)
+        return ceiling
+
+    def retryable(self, err: Exception, attempt: int) -> bool:
+        if attempt >= self.max_attempts:
+            return False
+        if isinstance(err, ClientError):
+            return err.error_code not in self.kFatalCodes
+        return isinstance(err, (ConnectionError, TimeoutError))
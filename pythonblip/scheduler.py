@@ -0,0 +1,219 @@
+##
+##
+
+import time
+import logging
+import threading
+import itertools
+from collections import deque
+from typing import List, Optional, Callable, Any
+from .frame import BLIPMessage, BLIPMessenger, Segment, kRequestType
+
+logger = logging.getLogger('pythonblip.scheduler')
+logger.addHandler(logging.NullHandler())
+
+
+class FlowControl(object):
+    kMinWindow = 64000
+    kMaxWindow = 4194304
+    kSmoothing = 0.125
+
+    def __init__(self,
+                 window: int = BLIPMessenger.kMaxUnackedBytes,
+                 auto_tune: bool = False,
+                 min_window: int = kMinWindow,
+                 max_window: int = kMaxWindow):
+        self.min_window = max(min_window, BLIPMessenger.kAckInterval + 1)
+        self.window = max(window, self.min_window)
+        self.auto_tune = auto_tune
+        self.max_window = max_window
+        self.srtt = None
+        self.throughput = None
+
+    def update(self, rtt: float, acked: int, elapsed: float):
+        if self.srtt is None:
+            self.srtt = rtt
+        else:
+            self.srtt += self.kSmoothing * (rtt - self.srtt)
+        if acked > 0 and elapsed > 0:
+            rate = acked / elapsed
+            if self.throughput is None:
+                self.throughput = rate
+            else:
+                self.throughput += self.kSmoothing * (rate - self.throughput)
+        if self.auto_tune and self.throughput:
+            window = 2 * self.throughput * self.srtt
+            self.window = int(min(max(window, self.min_window), self.max_window))
+            logger.debug("flow control rtt %.4f s throughput %.0f B/s window %d", self.srtt, self.throughput, self.window)
+
+
+class OutgoingMessage(object):
+    __slots__ = ('message', 'segments', 'index', 'offset', 'sent', 'started', 'acked', 'marks', 'last_ack')
+
+    def __init__(self, message: BLIPMessage, segments: List[Segment]):
+        self.message = message
+        self.segments = segments
+        self.index = 0
+        self.offset = 0
+        self.sent = 0
+        self.started = False
+        self.acked = 0
+        self.marks = deque()
+        self.last_ack = 0.0
+
+    @property
+    def done(self) -> bool:
+        return self.index >= len(self.segments)
+
+    @property
+    def is_request(self) -> bool:
+        return self.message.type == kRequestType
+
+    @property
+    def key(self):
+        return not self.is_request, self.message.number
+
+    @property
+    def unacked(self) -> int:
+        return self.sent - self.acked
+
+    def next_chunk(self, size: int) -> List[Segment]:
+        chunk = []
+        while size > 0 and self.index < len(self.segments):
+            segment = self.segments[self.index]
+            n = min(size, len(segment) - self.offset)
+            chunk.append(memoryview(segment)[self.offset:self.offset + n])
+            self.offset += n
+            size -= n
+            if self.offset == len(segment):
+                self.index += 1
+                self.offset = 0
+        self.started = True
+        return chunk
+
+
+class FrameScheduler(object):
+    kFrameSize = 16384
+    kUrgentBurst = 4
+
+    def __init__(self,
+                 messenger: BLIPMessenger,
+                 frame_size: int = kFrameSize,
+                 flow: FlowControl = None,
+                 wakeup: Callable[[], Any] = None):
+        self.messenger = messenger
+        self.wakeup = wakeup
+        self.frame_size = frame_size
+        self.flow = flow if flow else FlowControl()
+        self.lock = threading.Lock()
+        self.urgent = deque()
+        self.normal = deque()
+        self.unstarted = deque()
+        self.inflight = {}
+        self.numbers = itertools.count(1)
+        self.urgent_count = 0
+
+    def __len__(self):
+        with self.lock:
+            return len(self.urgent) + len(self.normal)
+
+    def enqueue(self, m: BLIPMessage, assign_number: bool = False, on_assign: Callable[[BLIPMessage], Any] = None):
+        if self.messenger.is_ack(m.type):
+            segments = []
+        else:
+            segments = self.messenger.payload(m)
+        out = OutgoingMessage(m, segments)
+        with self.lock:
+            if assign_number:
+                m.set_number(next(self.numbers))
+                if on_assign:
+                    on_assign(m)
+            if out.is_request:
+                self.unstarted.append(out)
+            if m.urgent:
+                self.urgent.append(out)
+            else:
+                self.normal.append(out)
+        if self.wakeup:
+            self.wakeup()
+        return m
+
+    def ready(self, out: OutgoingMessage) -> bool:
+        if out.is_request and not out.started:
+            return self.unstarted[0] is out
+        return out.unacked < self.flow.window
+
+    def select(self) -> Optional[OutgoingMessage]:
+        if self.urgent_count >= self.kUrgentBurst and self.normal:
+            queues = (self.normal, self.urgent)
+        else:
+            queues = (self.urgent, self.normal)
+        for queue in queues:
+            for n, out in enumerate(queue):
+                if self.ready(out):
+                    del queue[n]
+                    if queue is self.urgent:
+                        self.urgent_count += 1
+                    else:
+                        self.urgent_count = 0
+                    if out.is_request and not out.started:
+                        self.unstarted.popleft()
+                    return out
+        return None
+
+    def next_frame(self) -> Optional[List[Segment]]:
+        with self.lock:
+            out = self.select()
+        if not out:
+            return None
+
+        m = out.message
+        if not out.segments:
+            return self.messenger.compose(m)
+
+        started = out.started
+        chunk = out.next_chunk(self.frame_size)
+        more_coming = not out.done
+        segments = self.messenger.compose_frame(m, chunk, more_coming)
+
+        now = time.monotonic()
+        interval = BLIPMessenger.kAckInterval
+        previous = out.sent
+        ## Peers count the bytes that cross the wire, so the window is charged with the composed frame, not the
+        ## uncompressed chunk
+        out.sent += sum(len(segment) for segment in segments)
+        if out.sent // interval > previous // interval:
+            out.marks.append((out.sent, now))
+
+        with self.lock:
+            if more_coming:
+                if not started:
+                    out.last_ack = now
+                    self.inflight[out.key] = out
+                if m.urgent:
+                    self.urgent.append(out)
+                else:
+                    self.normal.append(out)
+            elif started:
+                self.inflight.pop(out.key, None)
+        return segments
+
+    def acknowledge(self, number: int, response: bool, byte_count: int):
+        now = time.monotonic()
+        with self.lock:
+            out = self.inflight.get((response, number))
+            if not out or byte_count <= out.acked:
+                return
+            rtt = None
+            while out.marks and out.marks[0][0] <= byte_count:
+                _, sent_time = out.marks.popleft()
+                rtt = now - sent_time
+            acked = byte_count - out.acked
+            elapsed = now - out.last_ack
+            out.acked = byte_count
+            out.last_ack = now
+            if rtt is not None:
+                self.flow.update(rtt, acked, elapsed)
+        logger.debug("message #%d acknowledged %d bytes", number, byte_count)
+        if self.wakeup:
+            self.wakeup()
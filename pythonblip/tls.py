@@ -0,0 +1,74 @@
+##
+##
+
+import ssl
+import logging
+import threading
+from typing import Optional, Tuple
+
+logger = logging.getLogger('pythonblip.tls')
+logger.addHandler(logging.NullHandler())
+
+
+class ResumingContext(ssl.SSLContext):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+
+    ## asyncio builds each TLS connection with wrap_bio(); offer the last session for the host so the server can resume it
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side and server_hostname:
+            with self.sessions_lock:
+                session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side=server_side, server_hostname=server_hostname, session=session)
+
+    def save_session(self, ssl_object: Optional[ssl.SSLObject]):
+        if ssl_object is None or ssl_object.server_side or not ssl_object.server_hostname:
+            return
+        session = ssl_object.session
+        if session is None:
+            return
+        logger.debug(f"TLS session for {ssl_object.server_hostname} reused: {ssl_object.session_reused}")
+        with self.sessions_lock:
+            self.sessions[ssl_object.server_hostname] = session
+
+    def forget(self, server_hostname: str):
+        with self.sessions_lock:
+            self.sessions.pop(server_hostname, None)
+
+
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+
+def context_key(verify: bool, cafile: Optional[str]) -> Tuple:
+    return verify, cafile
+
+
+def shared_context(verify: bool = False, cafile: Optional[str] = None) -> ResumingContext:
+    key = context_key(verify, cafile)
+    with _contexts_lock:
+        context = _contexts.get(key)
+        if context:
+            return context
+        context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        if verify:
+            context.check_hostname = True
+            context.verify_mode = ssl.CERT_REQUIRED
+        else:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        if cafile:
+            context.load_verify_locations(cafile=cafile)
+        else:
+            context.load_default_certs()
+        _contexts[key] = context
+        return context
+
+
+def clear_contexts():
+    with _contexts_lock:
+        _contexts.clear()
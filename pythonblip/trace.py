@@ -0,0 +1,57 @@
+##
+##
+
+import logging
+from collections import deque
+from typing import Iterable, Union
+
+logger = logging.getLogger('pythonblip.trace')
+logger.addHandler(logging.NullHandler())
+
+
+class FrameDump:
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def __iter__(self):
+        for i in range(0, len(self.buffer), 16):
+            block = bytearray(self.buffer[i: i + 16])
+            line = "{:08x}  {:23}  {:23}  |{:16}|".format(
+                i,
+                " ".join(("{:02x}".format(x) for x in block[:8])),
+                " ".join(("{:02x}".format(x) for x in block[8:])),
+                "".join((chr(x) if 32 <= x < 127 else "." for x in block)),
+            )
+            yield line
+        yield "{:08x}".format(len(self.buffer))
+
+    def __str__(self):
+        return "\n".join(self)
+
+    def __repr__(self):
+        return "\n".join(self)
+
+
+class FrameTracer(object):
+    kRingSize = 32
+
+    def __init__(self, size: int = kRingSize):
+        self.frames = deque(maxlen=size)
+
+    @property
+    def enabled(self) -> bool:
+        return logger.isEnabledFor(logging.DEBUG)
+
+    def record(self, direction: str, number: int, flags: int, frame: Union[bytes, Iterable[Union[bytes, bytearray, memoryview]]]):
+        if not isinstance(frame, bytes):
+            frame = b''.join(frame)
+        self.frames.append((direction, number, flags, frame))
+        logger.debug("%s frame #%d flags 0x%02x length %d", direction, number, flags, len(frame))
+
+    def dump(self):
+        if not self.frames:
+            return
+        logger.debug("last %d frames:", len(self.frames))
+        for direction, number, flags, frame in self.frames:
+            logger.debug("%s frame #%d flags 0x%02x\n%s", direction, number, flags, FrameDump(frame))
+        self.frames.clear()
@@ -0,0 +1,105 @@
+##
+##
+
+import socket
+import asyncio
+import logging
+from typing import Optional
+from websockets.uri import parse_uri
+
+logger = logging.getLogger('pythonblip.transport')
+logger.addHandler(logging.NullHandler())
+
+
+class TransportConfig(object):
+    kMaxSize = 2 ** 20
+    kReadLimit = 2 ** 16
+    kWriteLimit = 2 ** 16
+    kMaxQueue = 32
+    kOpenTimeout = 10.0
+
+    def __init__(self,
+                 compression: Optional[str] = "deflate",
+                 max_size: Optional[int] = kMaxSize,
+                 read_limit: int = kReadLimit,
+                 write_limit: int = kWriteLimit,
+                 max_queue: Optional[int] = kMaxQueue,
+                 nodelay: bool = True,
+                 recv_buffer: Optional[int] = None,
+                 send_buffer: Optional[int] = None,
+                 open_timeout: Optional[float] = kOpenTimeout):
+        self.compression = compression
+        self.max_size = max_size
+        self.read_limit = read_limit
+        self.write_limit = write_limit
+        self.max_queue = max_queue
+        self.nodelay = nodelay
+        self.recv_buffer = recv_buffer
+        self.send_buffer = send_buffer
+        self.open_timeout = open_timeout
+
+    ## BLIP already deflates message bodies, so websocket compression only burns CPU on an
+    ## incompressible stream; larger frames, buffers and socket windows keep a fast link full
+    @classmethod
+    def high_throughput(cls):
+        return cls(compression=None,
+                   max_size=2 ** 26,
+                   read_limit=2 ** 20,
+                   write_limit=2 ** 20,
+                   max_queue=256,
+                   nodelay=True,
+                   recv_buffer=2 ** 22,
+                   send_buffer=2 ** 22)
+
+    def connect_options(self) -> dict:
+        return {
+            "compression": self.compression,
+            "max_size": self.max_size,
+            "read_limit": self.read_limit,
+            "write_limit": self.write_limit,
+            "max_queue": self.max_queue,
+            "open_timeout": self.open_timeout,
+        }
+
+    ## Buffer sizes have to be on the socket before connect(): the receive buffer bounds the window scale offered
+    ## in the SYN and the window clamp. Explicit sizes also turn off Linux buffer autotuning, so without them the
+    ## connection is left to websockets and only NODELAY is set. websockets' open timeout does not cover a socket it
+    ## is handed, so resolving and connecting here are held to the same limit
+    async def open(self, uri: str) -> Optional[socket.socket]:
+        if not self.recv_buffer and not self.send_buffer:
+            return None
+        wsuri = parse_uri(uri)
+        loop = asyncio.get_running_loop()
+        deadline = None if self.open_timeout is None else loop.time() + self.open_timeout
+
+        def remaining() -> Optional[float]:
+            return None if deadline is None else max(deadline - loop.time(), 0)
+
+        addresses = await asyncio.wait_for(loop.getaddrinfo(wsuri.host, wsuri.port, type=socket.SOCK_STREAM), remaining())
+        error = OSError(f"no address found for {wsuri.host}")
+        for family, kind, proto, _, address in addresses:
+            sock = socket.socket(family, kind, proto)
+            try:
+                sock.setblocking(False)
+                self.configure(sock)
+                await asyncio.wait_for(loop.sock_connect(sock, address), remaining())
+                return sock
+            except OSError as err:
+                sock.close()
+                error = err
+            except BaseException:
+                sock.close()
+                raise
+        raise error
+
+    def configure(self, sock: Optional[socket.socket]):
+        if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+            return
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self.nodelay else 0)
+            if self.recv_buffer:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer)
+            if self.send_buffer:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+        except OSError as err:
+            logger.debug(f"can not set socket options: {err}")
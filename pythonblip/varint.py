@@ -2,14 +2,17 @@
 ##
 
 import struct
-from typing import Tuple
+from typing import Tuple, Iterable, List, Union
 from io import BytesIO
 import sys
+from .exceptions import VarintError
 
 MaxVarintLen16 = 3
 MaxVarintLen32 = 5
 MaxVarintLen64 = 10
 
+Buffer = Union[bytes, bytearray, memoryview]
+
 
 def uint64(n: int):
     return struct.pack('Q', n)
@@ -33,87 +36,116 @@ def from_int64(n: bytes):
     return struct.unpack('q', bytes(_output))[0]
 
 
+def encode_uvarint(x: int, buf: bytearray) -> int:
+    if x < 0x80:
+        buf.append(x)
+        return 1
+    start = len(buf)
+    while x >= 0x80:
+        buf.append((x & 0x7f) | 0x80)
+        x >>= 7
+    buf.append(x)
+    return len(buf) - start
+
+
+def decode_uvarint(buf: Buffer, offset: int = 0) -> Tuple[int, int]:
+    try:
+        b = buf[offset]
+        if b < 0x80:
+            return b, offset + 1
+        x = b & 0x7f
+        s = 7
+        i = offset + 1
+        end = offset + MaxVarintLen64
+        while i < end:
+            b = buf[i]
+            i += 1
+            if b < 0x80:
+                if i == end and b > 1:
+                    break
+                return x | b << s, i
+            x |= (b & 0x7f) << s
+            s += 7
+    except IndexError:
+        raise VarintError(f"truncated varint at offset {offset}", 0)
+    raise VarintError(f"varint overflows 64 bits at offset {offset}", -(i - offset))
+
+
+def encode_varint(x: int, buf: bytearray) -> int:
+    ux = x << 1
+    if x < 0:
+        ux = ~ux
+    return encode_uvarint(ux, buf)
+
+
+def decode_varint(buf: Buffer, offset: int = 0) -> Tuple[int, int]:
+    ux, offset = decode_uvarint(buf, offset)
+    x = ux >> 1
+    if ux & 1:
+        x = ~x
+    return x, offset
+
+
+def encode_many(values: Iterable[int], buf: bytearray) -> int:
+    start = len(buf)
+    for x in values:
+        encode_uvarint(x, buf)
+    return len(buf) - start
+
+
+def decode_many(buf: Buffer, count: int, offset: int = 0) -> Tuple[List[int], int]:
+    values = []
+    for _ in range(count):
+        x, offset = decode_uvarint(buf, offset)
+        values.append(x)
+    return values, offset
+
+
 def append_uvarint(buf: bytearray, x: bytes) -> bytearray:
-    _output = bytearray()
-    uvarint_ux = int.from_bytes(x, sys.byteorder)
-    while uvarint_ux >= 0x80:
-        b = uvarint_ux & 0xff
-        b = b | 0x80
-        _output.append(b)
-        uvarint_ux >>= 7
-    f = uvarint_ux & 0xff
-    _output.append(f)
-    buf.extend(_output)
+    encode_uvarint(int.from_bytes(x, sys.byteorder), buf)
     return buf
 
 
 def put_uvarint(x: bytes) -> Tuple[bytearray, int]:
     _output = bytearray()
-    uvarint_ux = int.from_bytes(x, sys.byteorder)
-    i = 0
-    while uvarint_ux >= 0x80:
-        b = uvarint_ux & 0xff
-        b = b | 0x80
-        _output.append(b)
-        uvarint_ux >>= 7
-        i += 1
-    f = uvarint_ux & 0xff
-    _output.append(f)
-    return _output, i + 1
+    n = encode_uvarint(int.from_bytes(x, sys.byteorder), _output)
+    return _output, n
 
 
 def uvarint(buf: bytearray) -> Tuple[int, int]:
-    x = 0
-    s = 0
-    for n in range(len(buf)):
-        if n == MaxVarintLen64:
-            return 0, -(n + 1)
-        b = int.from_bytes(buf[n:n + 1], sys.byteorder)
-        if b < 0x80:
-            if n == MaxVarintLen64 - 1 and b > 1:
-                return 0, -(n + 1)
-            x = x | b << s
-            return x, n + 1
-        x = x | (b & 0x7f) << s
-        s += 7
-    return 0, 0
+    try:
+        return decode_uvarint(buf)
+    except VarintError as err:
+        return 0, err.n
 
 
 def append_varint(buf: bytearray, x: bytes) -> bytearray:
-    varint_ux = struct.unpack('q', x)[0] << 1
-    if varint_ux < 0:
-        varint_ux = varint_ux ^ -1
-    return append_uvarint(buf, struct.pack('Q', varint_ux))
+    encode_varint(struct.unpack('q', x)[0], buf)
+    return buf
 
 
 def put_varint(x: bytes) -> Tuple[bytearray, int]:
-    varint_ux = struct.unpack('q', x)[0] << 1
-    if varint_ux < 0:
-        varint_ux = varint_ux ^ -1
-    return put_uvarint(struct.pack('Q', varint_ux))
+    _output = bytearray()
+    n = encode_varint(struct.unpack('q', x)[0], _output)
+    return _output, n
 
 
 def varint(buf: bytearray) -> Tuple[int, int]:
-    uvarint_ux, n = uvarint(buf)
-    varint_ux = uvarint_ux >> 1
-    if (uvarint_ux & 1) != 0:
-        varint_ux = varint_ux ^ -1
-    return varint_ux, n
+    try:
+        return decode_varint(buf)
+    except VarintError as err:
+        return 0, err.n
 
 
 def read_uvarint(r: BytesIO) -> Tuple[int, int]:
-    x = 0
-    s = 0
-    for n in range(MaxVarintLen64):
-        b = int.from_bytes(r.read(1), sys.byteorder)
-        if b < 0x80:
-            if n == MaxVarintLen64 - 1 and b > 1:
-                return 0, -(n + 1)
-            x = x | b << s
-            return x, n + 1
-        x = x | (b & 0x7f) << s
-        s += 7
-    return 0, 0
+    start = r.tell()
+    with r.getbuffer() as view:
+        try:
+            x, offset = decode_uvarint(view, start)
+        except VarintError as err:
+            return 0, err.n
+    r.seek(offset)
+    return x, offset - start
 
 
 def read_varint(r: BytesIO) -> Tuple[int, int]:
@@ -0,0 +1,801 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import pytest
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+sys.path.append(current)
+
+from pythonblip.varint import *
+from pythonblip.exceptions import VarintError
+
+
+def test_varint_codec_1():
+    numbers = [0, 1, 127, 128, 999, 16384, 2 ** 32, 2 ** 64 - 1]
+
+    for n in numbers:
+        buffer = bytearray(b'\xff')
+        length = encode_uvarint(n, buffer)
+        legacy, legacy_length = put_uvarint(uint64(n))
+        assert buffer[1:] == legacy
+        assert length == legacy_length
+        result, offset = decode_uvarint(memoryview(bytes(buffer)), 1)
+        assert result == n
+        assert offset == len(buffer)
+
+    for n in [0, -1, 1, -1024, 2 ** 62, -2 ** 63]:
+        buffer = bytearray()
+        encode_varint(n, buffer)
+        assert decode_varint(buffer) == (n, len(buffer))
+        assert varint(buffer) == (n, len(buffer))
+
+
+def test_varint_codec_2():
+    values = [1, 300, 0x41, 70000]
+    buffer = bytearray()
+    length = encode_many(values, buffer)
+    assert length == len(buffer)
+    result, offset = decode_many(memoryview(buffer), len(values))
+    assert result == values
+    assert offset == length
+
+    with pytest.raises(VarintError):
+        decode_uvarint(b'\x80\x80')
+    with pytest.raises(VarintError):
+        decode_uvarint(b'\xff' * 10 + b'\x01')
+    assert uvarint(bytearray(b'\x80')) == (0, 0)
+
+
+def test_messenger_1():
+    from pythonblip.frame import BLIPMessenger, BLIPMessage
+
+    sender = BLIPMessenger()
+    receiver = BLIPMessenger()
+
+    for n, body in enumerate([b'{"a":1}', b'', b'x' * 70000]):
+        m = BLIPMessage.construct()
+        m.set_number(n + 1)
+        m.compute_flag(0)
+        m.properties = {"Profile": "getCheckpoint", "client": "cp-1"}
+        m.body_import(body)
+        frame = b''.join(sender.compose(m))
+
+        r = receiver.receive(frame)
+        assert r.number == n + 1
+        assert r.type == 0
+        assert r.properties == {"Profile": "getCheckpoint", "client": "cp-1"}
+        assert r.body_as_bytes() == body
+
+
+def test_messenger_2():
+    from pythonblip.frame import BLIPMessenger, BLIPMessage
+
+    sender = BLIPMessenger()
+    receiver = BLIPMessenger()
+    body = b'{"type":"claim","region":"central"}' * 200
+
+    for n in range(3):
+        m = BLIPMessage.construct()
+        m.set_number(n + 1)
+        m.compressed = True
+        m.compute_flag(1)
+        m.properties = {"Profile": "rev", "id": f"doc::{n}"}
+        m.body_import(body)
+        segments = sender.compose(m)
+        assert isinstance(segments, list)
+        assert len(segments) <= 2
+        frame = b''.join(segments)
+        assert len(frame) < len(body)
+
+        r = receiver.receive(frame)
+        assert r.number == n + 1
+        assert r.compressed is True
+        assert r.properties == {"Profile": "rev", "id": f"doc::{n}"}
+        assert r.body_as_bytes() == body
+
+
+def test_tracer_1(caplog):
+    import logging
+    from pythonblip.frame import BLIPMessenger, BLIPMessage, FrameDump
+    from pythonblip import trace
+
+    assert FrameDump is trace.FrameDump
+
+    sender = BLIPMessenger(trace_size=4)
+
+    def send(n: int):
+        m = BLIPMessage.construct()
+        m.set_number(n)
+        m.properties = {"Profile": "getCheckpoint"}
+        sender.compose(m)
+
+    send(1)
+    assert len(sender.tracer.frames) == 0
+
+    with caplog.at_level(logging.DEBUG, logger='pythonblip.trace'):
+        for n in range(10):
+            send(n + 2)
+        assert len(sender.tracer.frames) == 4
+        caplog.clear()
+        sender.tracer.dump()
+        assert len(sender.tracer.frames) == 0
+        assert "sent frame #11" in caplog.text
+
+
+def test_message_1():
+    from pythonblip.frame import BLIPMessage, BLIPMessenger
+
+    m = BLIPMessage.construct()
+    m.urgent = True
+    m.no_reply = True
+    m.compute_flag(5)
+    assert m.type == 5
+    assert m.frame_flags == 0x35
+    m.urgent = False
+    assert m.frame_flags == 0x25
+    assert not hasattr(m, '__dict__')
+
+    m = BLIPMessage.construct()
+    m.set_number(7)
+    m.properties = {"Profile": "rev", "sequence": "12"}
+    frame = b''.join(BLIPMessenger().compose(m))
+    a = BLIPMessenger().receive(frame)
+    b = BLIPMessenger().receive(frame)
+    assert [id(k) for k in a.properties] == [id(k) for k in b.properties]
+    assert a.as_dict["urgent"] is False
+
+    with pytest.warns(DeprecationWarning):
+        block, length = m.prop_encode()
+    assert block == b'\0'.join([b'Profile', b'rev', b'sequence', b'12', b'']) and length == len(block)
+    c = BLIPMessage.construct()
+    with pytest.warns(DeprecationWarning):
+        c.prop_import(block)
+    assert c.properties == m.properties
+
+    e = BLIPMessenger().receive(b''.join(BLIPMessenger().error_frame(7, 404, "HTTP", "missing")))
+    assert e.number == 7
+    assert e.type == 2
+    assert e.properties == {"Error-Domain": "HTTP", "Error-Code": "404"}
+
+    from pythonblip import frame
+    with pytest.warns(DeprecationWarning):
+        e = BLIPMessenger().receive(b''.join(BLIPMessenger().error_frame(404, "HTTP", "missing")))
+    assert e.properties == {"Error-Domain": "HTTP", "Error-Code": "404"} and e.body_as_string() == "missing"
+    with pytest.warns(DeprecationWarning):
+        counter = frame.MPAtomicIncrement(5)
+    assert [counter.next, counter.next] == [5, 6]
+    with pytest.warns(DeprecationWarning):
+        assert isinstance(frame.message_number, frame.MPAtomicIncrement)
+    with pytest.warns(DeprecationWarning):
+        m.next_number()
+    assert m.number > e.number > 0
+
+
+def test_attachment_1(tmp_path):
+    from pythonblip.output import LocalDB, LocalFile
+
+    data = os.urandom(100000)
+    db = LocalDB(str(tmp_path)).database("test", ["_default"])
+    with db.open_attachment("doc::1", "image/png", len(data)) as writer:
+        for i in range(0, len(data), 16384):
+            writer.write(memoryview(data)[i:i + 16384])
+    assert writer.size == len(data)
+    row = db.db_files["test"]["cur"].execute("SELECT data FROM attachments WHERE doc_id = ?", ("doc::1",)).fetchone()
+    assert row[0] == data
+
+    ## a body shorter or longer than advertised is stored as received
+    for length in (len(data) + 5000, len(data) - 5000):
+        with db.open_attachment("doc::2", "image/png", length) as writer:
+            for i in range(0, len(data), 16384):
+                writer.write(memoryview(data)[i:i + 16384])
+        assert writer.size == len(data)
+        row = db.db_files["test"]["cur"].execute("SELECT data FROM attachments WHERE doc_id = ?", ("doc::2",)).fetchone()
+        assert row[0] == data
+    assert db.db_files["test"]["cur"].execute("SELECT count(*) FROM attachments").fetchone()[0] == 2
+
+    output = LocalFile(str(tmp_path)).database("test", ["_default"])
+    with output.open_attachment("doc::1", "image/png", len(data)) as writer:
+        writer.write(memoryview(data))
+    with open(writer.filename, 'rb') as data_file:
+        assert data_file.read() == data
+
+
+def test_properties_1():
+    from pythonblip.properties import PropertyCodec, encode_properties, decode_properties
+    from pythonblip.exceptions import PropertyError
+
+    properties = {"Profile": "rev", "id": 'doc {"quoted"}', "activeOnly": True, "maxHistory": 20}
+    block = encode_properties(properties)
+    length, offset = decode_uvarint(block)
+    assert length == len(block) - offset
+    assert decode_properties(block[offset:]) == {"Profile": "rev", "id": 'doc {"quoted"}', "activeOnly": "true", "maxHistory": "20"}
+    assert encode_properties(dict(properties)) is block
+    assert encode_properties({}) == b'\0'
+
+    tokenized = PropertyCodec(tokenize=True).encode({"Profile": "getAttachment", "Content-Type": "application/json"})
+    assert tokenized == b'\x14\x01\x00getAttachment\x00\x04\x00\x05\x00'
+    assert decode_properties(tokenized[1:]) == {"Profile": "getAttachment", "Content-Type": "application/json"}
+
+    with pytest.raises(PropertyError):
+        encode_properties({"id": "a\0b"})
+    with pytest.raises(PropertyError):
+        decode_properties(b'Profile\0rev')
+
+
+def test_compression_1():
+    from pythonblip.compression import CompressionPolicy
+    from pythonblip.frame import BLIPMessenger, BLIPMessage
+
+    reports = []
+    policy = CompressionPolicy(threshold=256, level=1, report=reports.append)
+    document = b'{"claim_id":"C-1001","region":"central","status":"open"}' * 40
+    assert policy.should_compress(document) is True
+    assert policy.should_compress(document[:100]) is False
+    assert policy.should_compress(os.urandom(4096)) is False
+    assert policy.should_compress(document, {"Content-Type": "image/jpeg"}) is False
+    assert CompressionPolicy.disabled().should_compress(document) is False
+
+    messenger = BLIPMessenger(compression=policy)
+    m = BLIPMessage.construct()
+    m.set_number(1)
+    m.compressed = True
+    m.body_import(document)
+    messenger.compose(m)
+    assert len(reports) == 1
+    assert reports[0].raw_bytes > len(document)
+    assert reports[0].ratio < 0.5
+    assert policy.messages == 1
+
+
+def test_scheduler_1():
+    from pythonblip.frame import BLIPMessenger, BLIPMessage
+    from pythonblip.scheduler import FrameScheduler
+
+    sender = BLIPMessenger()
+    receiver = BLIPMessenger()
+    outbox = FrameScheduler(sender, frame_size=4096)
+    body = os.urandom(20000)
+
+    def request(properties: dict, data: bytes = b'', urgent: bool = False):
+        m = BLIPMessage.construct()
+        m.urgent = urgent
+        m.properties = properties
+        m.body_import(data)
+        return outbox.enqueue(m, assign_number=True)
+
+    big = request({"Profile": "rev"}, body)
+    small = request({"Profile": "norev"})
+    frames = [b''.join(outbox.next_frame())]
+    urgent = request({"Profile": "setCheckpoint"}, urgent=True)
+    assert big.number < small.number < urgent.number
+
+    while True:
+        frame = outbox.next_frame()
+        if frame is None:
+            break
+        frames.append(b''.join(frame))
+    assert len(frames) == 7
+
+    messages = {}
+    order = []
+    for frame in frames:
+        number = decode_uvarint(frame)[0]
+        m = receiver.receive(frame, continuation=number in messages)
+        if number in messages:
+            messages[number].extend(m)
+        else:
+            messages[number] = m
+        order.append(number)
+    assert order[:4] == [big.number, small.number, urgent.number, big.number]
+    assert messages[big.number].body_as_bytes() == body
+    assert messages[big.number].more_coming is False
+    assert messages[urgent.number].properties == {"Profile": "setCheckpoint"}
+
+
+def test_flow_control_1():
+    from pythonblip.frame import BLIPMessenger, BLIPMessage
+    from pythonblip.scheduler import FrameScheduler, FlowControl
+
+    receiver = BLIPMessenger()
+    flow = FlowControl(window=64000, auto_tune=True)
+    outbox = FrameScheduler(BLIPMessenger(), frame_size=16384, flow=flow)
+    body = os.urandom(200000)
+
+    m = BLIPMessage.construct()
+    m.properties = {"Profile": "rev"}
+    m.body_import(body)
+    outbox.enqueue(m, assign_number=True)
+
+    frames = []
+    while True:
+        frame = outbox.next_frame()
+        if frame is None:
+            break
+        frames.append(b''.join(frame))
+    assert len(frames) == 4
+
+    r = receiver.receive(frames[0])
+    for frame in frames[1:]:
+        r.extend(receiver.receive(frame, continuation=True))
+    outbox.acknowledge(m.number, False, r.frame_total)
+    assert flow.srtt is not None
+    assert flow.window >= 64000
+
+    while True:
+        frame = outbox.next_frame()
+        if frame is None:
+            outbox.acknowledge(m.number, False, r.frame_total)
+            frame = outbox.next_frame()
+            if frame is None:
+                break
+        frame = b''.join(frame)
+        r.extend(receiver.receive(frame, continuation=True))
+    assert r.body_as_bytes() == body
+    assert m.number not in [key[1] for key in outbox.inflight]
+
+
+def test_flow_control_2():
+    import json
+    from pythonblip.frame import BLIPMessenger, BLIPMessage
+    from pythonblip.scheduler import FrameScheduler
+    from pythonblip.protocol import AsyncBLIPProtocol
+
+    sender = BLIPMessenger()
+    outbox = FrameScheduler(sender)
+    receiver = AsyncBLIPProtocol("ws://127.0.0.1:4984/test/_blipsync", {})
+    body = json.dumps([{"id": f"doc::{n}", "key": os.urandom(6).hex(), "value": "x" * 40}
+                       for n in range(14000)]).encode('utf-8')
+
+    m = BLIPMessage.construct()
+    m.properties = {"Profile": "rev"}
+    m.body_import(body)
+    m.compressed = True
+    outbox.enqueue(m, assign_number=True)
+
+    ## a peer that counts wire bytes, as Sync Gateway does, ACKs every 50000 of them
+    wire = 0
+    acks = []
+    while True:
+        frame = outbox.next_frame()
+        if frame is not None:
+            frame = b''.join(frame)
+            wire += len(frame)
+            receiver.incoming(frame)
+            continue
+        frame = receiver.outbox.next_frame()
+        if frame is None:
+            break
+        ack = sender.receive(b''.join(frame))
+        acks.append(ack.ack_bytes)
+        outbox.acknowledge(ack.number, False, ack.ack_bytes)
+
+    r = receiver.read_queue.get_nowait()
+    assert r.body_as_bytes() == body
+    assert wire < len(body) // 4
+    assert len(acks) == wire // BLIPMessenger.kAckInterval
+    assert acks == sorted(acks) and acks[-1] <= wire
+    assert outbox.inflight == {}
+
+
+def test_protocol_1(tmp_path):
+    import asyncio
+    from pythonblip.frame import BLIPMessenger, BLIPMessage
+    from pythonblip.protocol import AsyncBLIPProtocol
+    from pythonblip.exceptions import BLIPError, ClientError
+    from pythonblip.output import LocalDB
+
+    protocol = AsyncBLIPProtocol("ws://127.0.0.1:4984/test/_blipsync", {})
+    peer = BLIPMessenger()
+    db = LocalDB(str(tmp_path)).database("test", ["_default"])
+    data = os.urandom(20000)
+
+    def reply(m_type: int, number: int, properties: dict, body: bytes):
+        r = BLIPMessage(number, m_type, properties=properties)
+        r.body_import(body)
+        protocol.incoming(b''.join(peer.compose(r)))
+
+    async def exchange():
+        writer = db.open_attachment("doc::1", "image/png", len(data))
+        checkpoint = protocol.send_request({"Profile": "getCheckpoint"})
+        attachment = protocol.send_request({"Profile": "getAttachment"}, sink=writer.write)
+        missing = protocol.send_request({"Profile": "getCheckpoint"})
+        db.write("doc::1", {"_attachments": {}})
+
+        requests = []
+        while True:
+            frame = protocol.outbox.next_frame()
+            if frame is None:
+                break
+            requests.append(peer.receive(b''.join(frame)))
+        assert [r.number for r in requests] == [1, 2, 3]
+
+        reply(2, requests[2].number, {"Error-Domain": "HTTP", "Error-Code": "404"}, b'missing')
+        reply(1, requests[1].number, {}, data)
+        reply(1, requests[0].number, {"rev": "0-1"}, b'{"remote":10}')
+        reply(0, 99, {"Profile": "changes"}, b'[]')
+
+        assert (await protocol.response(checkpoint)).properties == {"rev": "0-1"}
+        await protocol.response(attachment)
+        writer.close()
+        with pytest.raises(BLIPError):
+            await protocol.response(missing)
+        assert (await protocol.receive_message()).properties == {"Profile": "changes"}
+        with pytest.raises(ClientError):
+            await protocol.receive_message(timeout=0.01)
+
+    asyncio.run(exchange())
+    assert protocol.pending == {}
+    row = db.db_files["test"]["cur"].execute("SELECT data FROM attachments WHERE doc_id = ?", ("doc::1",)).fetchone()
+    assert row[0] == data
+
+
+def test_scheduler_2():
+    from pythonblip.frame import BLIPMessenger, BLIPMessage
+    from pythonblip.scheduler import FrameScheduler
+
+    wakeups = []
+    outbox = FrameScheduler(BLIPMessenger(), wakeup=lambda: wakeups.append(1))
+    m = BLIPMessage.construct()
+    m.properties = {"Profile": "rev"}
+    m.body_import(os.urandom(200000))
+    outbox.enqueue(m, assign_number=True)
+    assert len(wakeups) == 1
+    while outbox.next_frame() is not None:
+        pass
+    outbox.acknowledge(m.number, False, 60000)
+    assert len(wakeups) == 2
+
+
+def test_client_1():
+    import asyncio
+    import threading
+    import websockets
+    from pythonblip.frame import BLIPMessenger, kRequestType
+    from pythonblip.protocol import AsyncBLIPProtocol
+
+    peer = BLIPMessenger()
+    received = []
+    polls = []
+
+    async def handler(websocket, *args):
+        async for data in websocket:
+            received.append(peer.receive(data))
+
+    async def exchange():
+        server = await websockets.serve(handler, "127.0.0.1", 0, subprotocols=['BLIP_3+CBMobile_3'])
+        port = server.sockets[0].getsockname()[1]
+        protocol = AsyncBLIPProtocol(f"ws://127.0.0.1:{port}/test/_blipsync", {})
+        next_frame = protocol.next_frame
+
+        def counted():
+            polls.append(1)
+            return next_frame()
+
+        protocol.next_frame = counted
+        await protocol.start()
+        await asyncio.sleep(0.1)
+        idle = len(polls)
+        await asyncio.sleep(0.3)
+        assert len(polls) == idle
+
+        thread = threading.Thread(target=protocol.send_message,
+                                  args=(kRequestType, {"Profile": "ping"}),
+                                  kwargs={"no_reply": True})
+        thread.start()
+        thread.join()
+        for _ in range(200):
+            if received:
+                break
+            await asyncio.sleep(0.01)
+        assert len(received) == 1
+        assert received[0].properties == {"Profile": "ping"}
+        assert len(polls) <= idle + 2
+
+        await protocol.stop()
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(exchange())
+
+
+def test_client_2():
+    import asyncio
+    import websockets
+    from pythonblip.frame import BLIPMessenger, BLIPMessage, kRequestType, kResponseType
+    from pythonblip.protocol import AsyncBLIPProtocol
+
+    peer = BLIPMessenger()
+
+    async def changes(websocket, first: int, count: int):
+        for n in range(first, first + count):
+            await websocket.send(b''.join(peer.compose(BLIPMessage(n, kRequestType, properties={"Profile": "changes"}))))
+
+    async def handler(websocket, *args):
+        await changes(websocket, 1, 10)
+        async for data in websocket:
+            m = peer.receive(data)
+            r = BLIPMessage(m.number, kResponseType, properties={"Profile": "pong"})
+            await websocket.send(b''.join(peer.compose(r)))
+            await changes(websocket, 11, 5)
+
+    async def exchange():
+        server = await websockets.serve(handler, "127.0.0.1", 0, subprotocols=['BLIP_3+CBMobile_3'])
+        port = server.sockets[0].getsockname()[1]
+        protocol = AsyncBLIPProtocol(f"ws://127.0.0.1:{port}/test/_blipsync", {}, capacity=2)
+        await protocol.start()
+        await asyncio.sleep(0.2)
+        assert protocol.read_queue.full()
+
+        ## a pending request does not lift the limit; its response waits behind the queued requests
+        ping = protocol.send_request({"Profile": "ping"})
+        await asyncio.sleep(0.2)
+        assert len(protocol.read_queue) == 2
+        assert not ping.done()
+
+        for n in range(1, 11):
+            assert (await protocol.receive_message(timeout=5)).number == n
+            assert len(protocol.read_queue) <= 2
+        r = await protocol.response(ping, timeout=5)
+        assert r.properties == {"Profile": "pong"}
+
+        await asyncio.sleep(0.2)
+        assert protocol.read_queue.full()
+        await asyncio.wait_for(protocol.stop(), 5)
+        assert protocol.run_status == 503
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(exchange())
+
+
+def test_handoff_1():
+    import asyncio
+    import threading
+    from queue import Empty
+    from pythonblip.handoff import FrameQueue
+
+    queue = FrameQueue(2)
+    frame = bytearray(b'frame')
+    queue.push(frame)
+    queue.push(b'second')
+    assert queue.full()
+    queue.push(0)
+    assert len(queue) == 3
+    assert queue.get() is frame
+    assert queue.get_nowait() == b'second'
+    assert queue.get_nowait() == 0
+    with pytest.raises(Empty):
+        queue.get(timeout=0.01)
+
+    received = []
+
+    def consumer():
+        for _ in range(10):
+            received.append(queue.get(timeout=5))
+
+    async def producer():
+        for n in range(10):
+            queue.push(n)
+            await queue.wait_space()
+            assert len(queue) < 2
+
+    thread = threading.Thread(target=consumer)
+    thread.start()
+    asyncio.run(producer())
+    thread.join()
+    assert received == list(range(10))
+
+
+def test_reactor_1():
+    import asyncio
+    from pythonblip.reactor import Reactor
+
+    async def work(n: int):
+        await asyncio.sleep(0)
+        return n * 2
+
+    reactor = Reactor()
+    futures = [reactor.submit(work(n)) for n in range(10)]
+    assert [f.result(5) for f in futures] == [n * 2 for n in range(10)]
+    assert reactor.run_sync(work(21)) == 42
+    reactor.stop()
+    assert not reactor.running
+
+
+def test_reactor_2():
+    import threading
+    from pythonblip.reactor import Reactor
+    from pythonblip.protocol import BLIPProtocol
+    from pythonblip.exceptions import ClientError
+
+    first = Reactor.shared(2)
+    second = Reactor.shared()
+    assert first is not second
+    assert Reactor.shared() in (first, second)
+
+    threads = threading.active_count()
+    protocols = [BLIPProtocol("ws://127.0.0.1:1/test/_blipsync", {}, shared=True) for _ in range(20)]
+    assert threading.active_count() == threads
+    for protocol in protocols:
+        with pytest.raises(ClientError):
+            protocol.response(protocol.send_request({"Profile": "getCheckpoint"}), timeout=5)
+        protocol.stop()
+    assert first.running and second.running
+    Reactor.shutdown_shared()
+    assert not first.running and not second.running
+
+
+def test_pool_1():
+    import asyncio
+    import websockets
+    from pythonblip.frame import BLIPMessenger, BLIPMessage
+    from pythonblip.pool import ConnectionPool
+
+    async def handler(websocket):
+        receiver, sender = BLIPMessenger(), BLIPMessenger()
+        async for data in websocket:
+            m = receiver.receive(data)
+            r = BLIPMessage(m.number, 1, properties={"Profile": m.properties["Profile"]})
+            await websocket.send(b''.join(sender.compose(r)))
+
+    async def run():
+        server = await websockets.serve(handler, "127.0.0.1", 0, subprotocols=['BLIP_3+CBMobile_3'])
+        target = f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}/test/_blipsync"
+        pool = ConnectionPool(max_idle=0.2)
+
+        first = await pool.acquire(target, {"Authorization": "a"})
+        assert (await first.response(first.send_request({"Profile": "getCheckpoint"}))).properties["Profile"] == "getCheckpoint"
+        await pool.release(first)
+        assert len(pool) == 1
+
+        second = await pool.acquire(target, {"Authorization": "a"})
+        assert second is first
+        other = await pool.acquire(target, {"Authorization": "b"})
+        assert other is not first
+        await pool.release(other, discard=True)
+        await pool.release(second)
+        assert (pool.hits, pool.misses, len(pool)) == (1, 2, 1)
+
+        await asyncio.sleep(0.4)
+        assert len(pool) == 0
+        await asyncio.sleep(0.1)
+        assert first.connection.done()
+        await pool.close()
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(run())
+
+
+def test_retry_1():
+    from pythonblip.retry import RetryPolicy
+    from pythonblip.replicator import sequence_key
+    from pythonblip.exceptions import ClientError
+
+    policy = RetryPolicy(max_attempts=3, base_delay=1.0, max_delay=5.0)
+    for attempt in range(6):
+        assert 0 <= policy.delay(attempt) <= min(5.0, 2 ** attempt)
+    assert RetryPolicy(jitter=False, base_delay=1.0, max_delay=5.0).delay(4) == 5.0
+    assert policy.retryable(ClientError(503, "Connection closed"), 0)
+    assert policy.retryable(ConnectionResetError(), 2)
+    assert not policy.retryable(ClientError(503, "Connection closed"), 3)
+    assert not policy.retryable(ClientError(401, "Unauthorized"), 0)
+    assert not RetryPolicy.disabled().retryable(ClientError(500, "error"), 0)
+
+    assert sorted([12, "3", "10:11", "9"], key=sequence_key) == ["3", "9", "10:11", 12]
+
+
+def test_transport_1():
+    import asyncio
+    import socket
+    import websockets
+    from pythonblip.protocol import AsyncBLIPProtocol
+    from pythonblip.transport import TransportConfig
+
+    class RecordingConfig(TransportConfig):
+        def configure(self, sock):
+            try:
+                sock.getpeername()
+                connected = True
+            except OSError:
+                connected = False
+            self.configured = (sock.fileno(), connected)
+            super().configure(sock)
+
+    async def handler(websocket):
+        await websocket.wait_closed()
+
+    async def run():
+        server = await websockets.serve(handler, "127.0.0.1", 0, subprotocols=['BLIP_3+CBMobile_3'])
+        target = f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}/test/_blipsync"
+        results = []
+        for transport in (RecordingConfig(), RecordingConfig.high_throughput()):
+            protocol = AsyncBLIPProtocol(target, {}, transport=transport)
+            await protocol.start()
+            sock = protocol.websocket.transport.get_extra_info('socket')
+            assert transport.configured[0] == sock.fileno()
+            results.append((len(protocol.websocket.extensions),
+                            protocol.websocket.max_size,
+                            sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY) != 0,
+                            sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+                            transport.configured[1]))
+            await protocol.stop()
+        server.close()
+        await server.wait_closed()
+        return results
+
+    default, fast = asyncio.run(run())
+    assert default[0] == 1 and fast[0] == 0
+    assert fast[1] == 2 ** 26
+    assert default[2] and fast[2]
+    assert fast[3] >= default[3]
+    ## buffer sizes are applied before connect, the default leaves the connection to websockets
+    assert default[4] and not fast[4]
+
+
+def test_transport_2(monkeypatch):
+    import time
+    import asyncio
+    import asyncio.selector_events
+    from pythonblip.transport import TransportConfig
+
+    async def hang(self, sock, address):
+        await asyncio.sleep(60)
+
+    async def nowhere(self, *args, **kwargs):
+        return []
+
+    transport = TransportConfig(recv_buffer=2 ** 20, open_timeout=0.2)
+    with monkeypatch.context() as patch:
+        patch.setattr(asyncio.selector_events.BaseSelectorEventLoop, "sock_connect", hang)
+        start = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(transport.open("ws://127.0.0.1:4984/test/_blipsync"))
+        assert time.monotonic() - start < 5
+    with monkeypatch.context() as patch:
+        patch.setattr(asyncio.BaseEventLoop, "getaddrinfo", nowhere)
+        with pytest.raises(OSError, match="no address"):
+            asyncio.run(transport.open("ws://sgw.example.com:4984/test/_blipsync"))
+
+
+def test_tls_1(tmp_path):
+    import ssl
+    import asyncio
+    import shutil
+    import subprocess
+    import websockets
+    from pythonblip.protocol import AsyncBLIPProtocol
+    from pythonblip.tls import shared_context
+    from pythonblip.transport import TransportConfig
+
+    if not shutil.which("openssl"):
+        pytest.skip("openssl not available")
+    key, cert = str(tmp_path / "key.pem"), str(tmp_path / "cert.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out", cert,
+                    "-days", "1", "-subj", "/CN=localhost"], check=True, capture_output=True)
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(cert, key)
+
+    assert shared_context() is shared_context()
+    assert shared_context(cafile=cert) is not shared_context()
+
+    async def handler(websocket):
+        await websocket.wait_closed()
+
+    async def run():
+        server = await websockets.serve(handler, "localhost", 0, ssl=server_context, subprotocols=['BLIP_3+CBMobile_3'])
+        target = f"wss://localhost:{server.sockets[0].getsockname()[1]}/test/_blipsync"
+        reused = []
+        for transport in (TransportConfig(), TransportConfig(), TransportConfig.high_throughput()):
+            protocol = AsyncBLIPProtocol(target, {}, tls=True, transport=transport)
+            await protocol.start()
+            reused.append(protocol.websocket.transport.get_extra_info('ssl_object').session_reused)
+            await protocol.stop()
+        server.close()
+        await server.wait_closed()
+        return reused
+
+    assert asyncio.run(run()) == [False, True, True]
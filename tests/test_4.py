@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import asyncio
+import pytest
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+sys.path.append(current)
+
+from pythonblip.emulator import BLIPEmulator, SyntheticDatabase
+from pythonblip.replicator import Replicator, AsyncReplicator, ReplicatorConfiguration, ReplicatorType
+from pythonblip.headers import BasicAuth
+from pythonblip.output import LocalDB, LocalFile
+from pythonblip.reactor import Reactor
+from pythonblip.retry import RetryPolicy
+from pythonblip.exceptions import ReplicationError
+
+
+def configuration(emulator: BLIPEmulator, output, **kwargs):
+    return ReplicatorConfiguration.create(emulator.database.name,
+                                          emulator.host,
+                                          ReplicatorType.PULL,
+                                          BasicAuth("user", "password"),
+                                          port=str(emulator.port),
+                                          output=output,
+                                          **kwargs)
+
+
+def test_emulator_1(tmp_path):
+    reactor = Reactor()
+    database = SyntheticDatabase("test", 300, attachments=25, attachment_size=100000)
+    emulator = BLIPEmulator(database, batch_size=1000)
+    reactor.run_sync(emulator.start())
+
+    output = LocalDB(str(tmp_path))
+    replicator = Replicator(configuration(emulator, output), reactor=reactor)
+    replicator.start()
+    replicator.replicate()
+    replicator.stop()
+
+    cursor = output.db_files["test"]["cur"]
+    assert cursor.execute("SELECT count(*) FROM documents").fetchone()[0] == 300
+    rows = cursor.execute("SELECT doc_id, data FROM attachments ORDER BY doc_id").fetchall()
+    assert len(rows) == 12
+    blobs = {document.doc_id: database.blobs[document.attachment["digest"]]
+             for document in database.collections["_default"] if document.attachment}
+    assert all(blobs[doc_id] == data for doc_id, data in rows)
+    assert [checkpoint[1]["remote"] for checkpoint in emulator.checkpoints.values()] == [300]
+
+    reactor.run_sync(emulator.stop())
+    reactor.stop()
+
+
+def test_emulator_2(tmp_path):
+    async def run():
+        emulator = BLIPEmulator(SyntheticDatabase("test", 200), batch_size=1000, latency=0.01, drop_after=120)
+        await emulator.start()
+        output = LocalFile(str(tmp_path))
+        replicator = AsyncReplicator(configuration(emulator, output, retry=RetryPolicy(base_delay=0.01)))
+        await replicator.start()
+        await replicator.replicate()
+        await replicator.stop()
+        await emulator.stop()
+        return emulator
+
+    emulator = asyncio.run(run())
+    assert emulator.connections == 2
+    with open(tmp_path / "test.jsonl") as jsonl_file:
+        lines = jsonl_file.readlines()
+    assert len(lines) == 200
+
+
+def test_emulator_3(tmp_path):
+    async def run():
+        emulator = BLIPEmulator(SyntheticDatabase("test", 10), auth=BasicAuth("admin", "secret"))
+        await emulator.start()
+        replicator = AsyncReplicator(configuration(emulator, LocalFile(str(tmp_path))))
+        try:
+            with pytest.raises(ReplicationError, match="Unauthorized"):
+                await replicator.start()
+        finally:
+            await emulator.stop()
+
+    asyncio.run(run())
+
+
+def test_emulator_4(tmp_path):
+    async def wait_for(output, count: int):
+        cursor = output.db_files["test"]["cur"]
+        while cursor.execute("SELECT count(*) FROM documents").fetchone()[0] < count:
+            await asyncio.sleep(0.01)
+
+    async def run():
+        database = SyntheticDatabase("test", 100)
+        emulator = BLIPEmulator(database, batch_size=40)
+        await emulator.start()
+        output = LocalDB(str(tmp_path))
+        replicator = AsyncReplicator(configuration(emulator, output, continuous=True, checkpoint_interval=0.05))
+        await replicator.start()
+        task = asyncio.get_running_loop().create_task(replicator.replicate())
+        await asyncio.wait_for(wait_for(output, 100), 5)
+        database.add("_default", 50)
+        await asyncio.wait_for(wait_for(output, 150), 5)
+        await replicator.stop()
+        await task
+        await emulator.stop()
+        return emulator
+
+    emulator = asyncio.run(run())
+    assert emulator.connections == 1
+    assert [checkpoint[1]["remote"] for checkpoint in emulator.checkpoints.values()] == [150]
+
+
+def test_emulator_5(tmp_path):
+    async def pull(emulator: BLIPEmulator, directory):
+        output = LocalFile(str(directory))
+        replicator = AsyncReplicator(configuration(emulator, output, scope="data", collections=["one", "two"]))
+        await replicator.start()
+        await replicator.replicate()
+        await replicator.stop()
+
+    async def run():
+        database = SyntheticDatabase("test", 50, scope="data", collections=["one", "two"])
+        emulator = BLIPEmulator(database, batch_size=20)
+        await emulator.start()
+        await pull(emulator, tmp_path / "full")
+        database.add("two", 5)
+        await pull(emulator, tmp_path / "delta")
+        await emulator.stop()
+        return emulator
+
+    (tmp_path / "full").mkdir()
+    (tmp_path / "delta").mkdir()
+    emulator = asyncio.run(run())
+    assert sorted(checkpoint[1]["remote"] for checkpoint in emulator.checkpoints.values()) == [50, 105]
+    lines = {}
+    for run in ("full", "delta"):
+        for collection in ("one", "two"):
+            with open(tmp_path / run / f"{collection}.jsonl") as jsonl_file:
+                lines[(run, collection)] = len(jsonl_file.readlines())
+    assert lines == {("full", "one"): 50, ("full", "two"): 50, ("delta", "one"): 0, ("delta", "two"): 5}
+
+
+def test_emulator_6(tmp_path):
+    async def run():
+        database = SyntheticDatabase("test", 1000, size=256, attachments=20, attachment_size=20000)
+        emulator = BLIPEmulator(database, batch_size=25, latency=0.001)
+        await emulator.start()
+        output = LocalDB(str(tmp_path))
+        replicator = AsyncReplicator(configuration(emulator, output))
+        await replicator.start()
+        await replicator.replicate()
+        await replicator.stop()
+        await emulator.stop()
+        return database, emulator, output
+
+    database, emulator, output = asyncio.run(run())
+    cursor = output.db_files["test"]["cur"]
+    assert cursor.execute("SELECT count(DISTINCT doc_id) FROM documents").fetchone()[0] == 1000
+    rows = cursor.execute("SELECT doc_id, data FROM attachments").fetchall()
+    assert len(rows) == 50
+    blobs = {document.doc_id: database.blobs[document.attachment["digest"]]
+             for document in database.collections["_default"] if document.attachment}
+    assert all(blobs[doc_id] == data for doc_id, data in rows)
+    assert [checkpoint[1]["remote"] for checkpoint in emulator.checkpoints.values()] == [1000]
+
+
+def test_emulator_7(tmp_path):
+    collections = ["one", "two", "three", "four"]
+
+    async def run():
+        database = SyntheticDatabase("test", 60, scope="data", collections=collections)
+        emulator = BLIPEmulator(database, batch_size=20, drop_after=100)
+        await emulator.start()
+        output = LocalFile(str(tmp_path))
+        replicator = AsyncReplicator(configuration(emulator, output, scope="data", collections=collections,
+                                                   concurrency=4, retry=RetryPolicy(base_delay=0.01)))
+        await replicator.start()
+        await replicator.replicate()
+        await replicator.stop()
+        await emulator.stop()
+        return emulator
+
+    emulator = asyncio.run(run())
+    assert emulator.connections == 2
+    assert sorted(checkpoint[1]["remote"] for checkpoint in emulator.checkpoints.values()) == [60, 120, 180, 240]
+    for collection in collections:
+        with open(tmp_path / f"{collection}.jsonl") as jsonl_file:
+            assert len(jsonl_file.readlines()) == 60
+
+
+def test_emulator_8(tmp_path):
+    collections = ["one", "two"]
+
+    async def wait_for(output, count: int):
+        while True:
+            counts = []
+            for collection in collections:
+                with open(tmp_path / f"{collection}.jsonl") as jsonl_file:
+                    counts.append(len(jsonl_file.readlines()))
+            if counts == [count, count]:
+                return
+            await asyncio.sleep(0.01)
+
+    async def run():
+        database = SyntheticDatabase("test", 30, scope="data", collections=collections)
+        emulator = BLIPEmulator(database)
+        await emulator.start()
+        output = LocalFile(str(tmp_path))
+        replicator = AsyncReplicator(configuration(emulator, output, scope="data", collections=collections,
+                                                   continuous=True, concurrency=1))
+        await replicator.start()
+        task = asyncio.get_running_loop().create_task(replicator.replicate())
+        await asyncio.wait_for(wait_for(output, 30), 5)
+        database.add("one", 10)
+        database.add("two", 10)
+        await asyncio.wait_for(wait_for(output, 40), 5)
+        await replicator.stop()
+        await task
+        await emulator.stop()
+        return emulator
+
+    emulator = asyncio.run(run())
+    assert sorted(checkpoint[1]["remote"] for checkpoint in emulator.checkpoints.values()) == [70, 80]
+
+
+def test_emulator_9(tmp_path):
+    async def run():
+        database = SyntheticDatabase("test", 5000, size=64)
+        emulator = BLIPEmulator(database, batch_size=200)
+        await emulator.start()
+        output = LocalFile(str(tmp_path))
+        replicator = AsyncReplicator(configuration(emulator, output, checkpoint_interval=0.01))
+        await replicator.start()
+        await asyncio.wait_for(replicator.replicate(), 30)
+        await asyncio.wait_for(replicator.stop(), 5)
+        await emulator.stop()
+        return emulator
+
+    emulator = asyncio.run(run())
+    (rev, body), = emulator.checkpoints.values()
+    assert body["remote"] == 5000
+    assert int(rev.split('-')[-1]) > 2
+    with open(tmp_path / "test.jsonl") as jsonl_file:
+        assert len(jsonl_file.readlines()) == 5000
+
+
+def test_emulator_10(tmp_path, monkeypatch):
+    from pythonblip.replicator import CollectionRouter
+    collections = ["one", "two", "three", "four"]
+
+    class TrackingReplicator(AsyncReplicator):
+        active = 0
+        peak = 0
+
+        async def replicate_collection(self, *args, **kwargs):
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            try:
+                await super().replicate_collection(*args, **kwargs)
+            finally:
+                self.active -= 1
+
+    monkeypatch.setattr(CollectionRouter, "kInboxSize", 2)
+
+    async def run():
+        database = SyntheticDatabase("test", 200, scope="data", collections=collections)
+        emulator = BLIPEmulator(database, batch_size=20, latency=0.005)
+        await emulator.start()
+        output = LocalFile(str(tmp_path))
+        replicator = TrackingReplicator(configuration(emulator, output, scope="data", collections=collections,
+                                                      concurrency=2))
+        await replicator.start()
+        await asyncio.wait_for(replicator.replicate(), 30)
+        await replicator.stop()
+        await emulator.stop()
+        return replicator
+
+    replicator = asyncio.run(run())
+    assert replicator.peak == 2
+    assert "collection" not in replicator.sub_changes_props and "since" not in replicator.sub_changes_props
+    assert "collection" not in replicator.set_checkpoint_props
+    for collection in collections:
+        with open(tmp_path / f"{collection}.jsonl") as jsonl_file:
+            assert len(jsonl_file.readlines()) == 200